@@ -0,0 +1,97 @@
+import sys
+import time
+import random
+
+from modules.relay.routing import RoutingTable
+
+
+# Subscriptions roughly as they appear on a farm: most connections are
+# miners, a handful are dashboards and one is the compute module.
+MINER_SUBSCRIPTIONS = {'machine': ['action'], 'fee': ['update']}
+DASHBOARD_SUBSCRIPTIONS = {'machines': ['*'], 'messages': ['*'], 'stats': ['response'], 'coins': ['*']}
+COMPUTE_SUBSCRIPTIONS = {'connection': ['*'], 'machines': ['*'], 'machine': ['*'], 'messages': ['*'], 'stats': ['query'], '*': ['get']}
+
+ROUTES = [('machines', 'new_stats'), ('machines', 'stats'), ('machine', 'action'), ('messages', 'patch'),
+            ('connection', 'open'), ('coins', 'get'), ('stats', 'query'), ('fee', 'update')]
+
+class ListRouting:
+    '''The relay's previous routing: nested lists, walked per packet.'''
+
+    def __init__(self):
+        self.subscriptions = {}
+
+    def add(self, id, subscriptions):
+        for event, methods in subscriptions.items():
+            if event not in self.subscriptions: self.subscriptions[event] = {}
+            for method in methods:
+                if method not in self.subscriptions[event]: self.subscriptions[event][method] = []
+                self.subscriptions[event][method].append(id)
+
+    def remove(self, id, subscriptions):
+        for event, methods in subscriptions.items():
+            for method in methods:
+                self.subscriptions[event][method].remove(id)
+
+    def route(self, event, method):
+        ids = []
+
+        for e in [event, '*']:
+            if e in self.subscriptions:
+                for m in [method, '*']:
+                    if m in self.subscriptions[e]:
+                        ids.extend(self.subscriptions[e][m])
+
+        return ids
+
+def connections(count):
+    conns = [('compute', COMPUTE_SUBSCRIPTIONS)]
+
+    for i in range(count - 1):
+        if i % 100 == 0:
+            conns.append(('dashboard-%d' % i, DASHBOARD_SUBSCRIPTIONS))
+        else:
+            conns.append(('miner-%d' % i, MINER_SUBSCRIPTIONS))
+
+    return conns
+
+def bench(table, conns, packets):
+    results = {}
+
+    t = time.perf_counter()
+    for id, subs in conns:
+        table.add(id, subs)
+    results['subscribe'] = time.perf_counter() - t
+
+    routes = [random.choice(ROUTES) for i in range(packets)]
+
+    t = time.perf_counter()
+    for event, method in routes:
+        for id in table.route(event, method):
+            pass
+    results['route'] = time.perf_counter() - t
+
+    # A mass reconnect: every connection drops, then comes back.
+    order = list(conns)
+    random.shuffle(order)
+
+    t = time.perf_counter()
+    for id, subs in order:
+        table.remove(id, subs)
+    results['unsubscribe'] = time.perf_counter() - t
+
+    return results
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    packets = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+
+    conns = connections(count)
+
+    print('%d connections, %d packets' % (count, packets))
+    print('%-14s %12s %12s %12s' % ('', 'subscribe', 'route/pkt', 'unsubscribe'))
+
+    for name, table in [('lists', ListRouting()), ('routing table', RoutingTable())]:
+        random.seed(0)
+        results = bench(table, conns, packets)
+
+        print('%-14s %10.2fms %10.2fus %10.2fms' % (name, results['subscribe'] * 1000, results['route'] / packets * 1000000, results['unsubscribe'] * 1000))
@@ -0,0 +1,260 @@
+import json
+import struct
+
+from ivy.compression import decompress
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+
+_UNDECODED = object()
+
+class Body:
+    def __init__(self, payload=None, raw=None, codec=None):
+        # A body is either built from a payload, or received as `raw` data
+        # from `codec` and only decoded once somebody asks for the payload.
+        # The raw data is what gets forwarded, even after decoding.
+        self._payload = payload if raw is None else _UNDECODED
+
+        self.raw = raw
+        self.codec = codec
+
+        # Bytes on the wire, for received bodies
+        self.size = None
+
+        self.encoded = {}
+
+    @property
+    def payload(self):
+        if self._payload is _UNDECODED:
+            self._payload = self.codec.loads(self.raw)
+        return self._payload
+
+    def empty(self):
+        return self.raw is None and self._payload is None
+
+    def falsy(self):
+        # Falsy payloads encode to a handful of bytes, so only short raw
+        # data has to be decoded to tell.
+        if self._payload is _UNDECODED and len(self.raw) > 16:
+            return False
+        return not self.payload
+
+    def encode(self, codec):
+        if codec.format not in self.encoded:
+            if self.raw is not None and self.codec.format == codec.format:
+                self.encoded[codec.format] = self.raw
+            else:
+                self.encoded[codec.format] = codec.dumps(self.payload)
+        return self.encoded[codec.format]
+
+    def compress(self, codec, compression):
+        key = (codec.format, compression.key)
+
+        if key not in self.encoded:
+            data = self.encode(codec)
+            self.encoded[key] = compression.compress(data.encode('utf-8') if isinstance(data, str) else data)
+        return self.encoded[key]
+
+    def compressed(self, codec, compression):
+        # Returns the compressed payload, or None if it's too small to bother.
+        if compression is None or self.empty():
+            return None
+
+        if len(self.encode(codec)) < compression.threshold:
+            return None
+
+        return self.compress(codec, compression)
+
+class Frame:
+    def __init__(self, event, method, body=None, to=None, sender=None, rpc=None):
+        self.event = event
+        self.method = method
+
+        self.body = body if body is not None else Body()
+
+        self.to = to
+        self.sender = sender
+
+        # {id, op, timeout}, see Net.request
+        self.rpc = rpc
+
+        self.encoded = {}
+
+    def envelope(self, to=None, sender=None):
+        # Shares the body, so the payload is still only serialized once.
+        return Frame(self.event, self.method, self.body, to=to, sender=sender, rpc=self.rpc)
+
+    def header(self):
+        header = {'event': self.event, 'method': self.method}
+
+        if self.sender: header['from'] = self.sender
+        if self.to: header['to'] = self.to
+        if self.rpc: header['rpc'] = self.rpc
+
+        return header
+
+    def encode(self, codec=None, compression=None):
+        if codec is None: codec = JSON
+
+        key = (codec.name, compression.key if compression is not None else None)
+
+        if key not in self.encoded:
+            self.encoded[key] = codec.pack(self, compression)
+        return self.encoded[key]
+
+class JSONCodec:
+    # The whole packet as a single JSON object. This is what the dashboard
+    # and older Ivy installs speak.
+    name = 'json'
+    format = 'json'
+
+    def dumps(self, payload):
+        return json.dumps(payload)
+
+    def loads(self, data):
+        return json.loads(data)
+
+    def pack(self, frame, compression=None):
+        # Plain JSON peers rely on permessage-deflate instead of `compression`.
+
+        # Spliced together by hand so the (usually much larger) payload
+        # can be reused as-is. Matches what json.dumps would produce.
+        data = '{"event": %s, "method": %s' % (json.dumps(frame.event), json.dumps(frame.method))
+
+        if frame.sender: data += ', "from": %s' % json.dumps(frame.sender)
+        if frame.to: data += ', "to": %s' % json.dumps(frame.to)
+        if frame.rpc: data += ', "rpc": %s' % json.dumps(frame.rpc)
+
+        # Falsy payloads have always been left out of plain JSON packets.
+        if not frame.body.falsy(): data += ', "payload": %s' % frame.body.encode(self)
+
+        return data + '}'
+
+    def unpack(self, data):
+        header = json.loads(data)
+
+        return header, Body(header.pop('payload', None))
+
+class EnvelopeCodec(JSONCodec):
+    # A small routing header on the first line, followed by the payload.
+    # The relay only ever has to parse the header to forward a packet.
+    # Compressed payloads are sent as binary frames.
+    name = 'ivy-json'
+
+    def pack(self, frame, compression=None):
+        header = frame.header()
+
+        compressed = frame.body.compressed(self, compression)
+        if compressed is not None:
+            header['z'] = compression.key
+            return json.dumps(header).encode('utf-8') + b'\n' + compressed
+
+        data = json.dumps(header)
+
+        if not frame.body.empty():
+            data += '\n' + frame.body.encode(self)
+
+        return data
+
+    def unpack(self, data):
+        if isinstance(data, bytes):
+            header, _, payload = data.partition(b'\n')
+            header = json.loads(header.decode('utf-8'))
+
+            if header.pop('z', None):
+                payload = decompress(payload)
+
+            payload = payload.decode('utf-8')
+        else:
+            header, _, payload = data.partition('\n')
+            header = json.loads(header)
+
+        return header, Body(raw=payload, codec=self) if payload else Body()
+
+class BinaryEnvelopeCodec:
+    # The same split as 'ivy-json', in a binary encoding: a length-prefixed
+    # header, followed by the payload.
+    name = None
+    format = None
+
+    def dumps(self, payload):
+        raise NotImplementedError()
+
+    def loads(self, data):
+        raise NotImplementedError()
+
+    def pack(self, frame, compression=None):
+        header = frame.header()
+
+        payload = frame.body.compressed(self, compression)
+        if payload is not None:
+            header['z'] = compression.key
+        elif not frame.body.empty():
+            payload = frame.body.encode(self)
+
+        header = self.dumps(header)
+
+        return struct.pack('!I', len(header)) + header + (payload if payload is not None else b'')
+
+    def unpack(self, data):
+        length = struct.unpack_from('!I', data)[0]
+
+        header = self.loads(data[4:4 + length])
+        payload = data[4 + length:]
+
+        if header.pop('z', None):
+            payload = decompress(payload)
+
+        return header, Body(raw=payload, codec=self) if payload else Body()
+
+class MsgpackCodec(BinaryEnvelopeCodec):
+    name = 'ivy-msgpack'
+    format = 'msgpack'
+
+    def dumps(self, payload):
+        return msgpack.packb(payload, use_bin_type=True)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+class CBORCodec(BinaryEnvelopeCodec):
+    name = 'ivy-cbor'
+    format = 'cbor'
+
+    def dumps(self, payload):
+        return cbor2.dumps(payload)
+
+    def loads(self, data):
+        return cbor2.loads(data)
+
+JSON = JSONCodec()
+
+CODECS = {codec.name: codec for codec in [JSON, EnvelopeCodec()]}
+
+# The binary codecs are only offered when their library is installed.
+if msgpack is not None: CODECS[MsgpackCodec.name] = MsgpackCodec()
+if cbor2 is not None: CODECS[CBORCodec.name] = CBORCodec()
+
+# Offered by NetConnector, most preferred first.
+PREFERRED_CODECS = [name for name in ['ivy-msgpack', 'ivy-cbor', 'ivy-json'] if name in CODECS]
+
+def negotiate(offer):
+    if offer:
+        for name in offer.split(','):
+            name = name.strip()
+
+            if name in CODECS:
+                return CODECS[name]
+
+    return JSON
+
+def get_codec(name):
+    return CODECS[name] if name in CODECS else JSON
@@ -0,0 +1,81 @@
+import time
+import zlib
+import ipaddress
+
+
+# Compression is skipped for peers on the same machine or network. It costs
+# more CPU than it saves bandwidth there.
+DEFAULT_POLICY = {
+    'enabled': True,
+    'lan': False,
+
+    # permessage-deflate, for peers that can't do payload compression (the dashboard)
+    'deflate': True,
+
+    # Payloads smaller than this (in bytes) are sent as-is.
+    'threshold': 16 * 1024,
+    'level': 6
+}
+
+class CompressionStats:
+    def __init__(self):
+        self.messages = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds = 0
+
+    def record(self, bytes_in, bytes_out, seconds):
+        self.messages += 1
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+        self.seconds += seconds
+
+    def ratio(self):
+        return self.bytes_out / self.bytes_in if self.bytes_in > 0 else 1
+
+    def __repr__(self):
+        return '%d payloads, %d -> %d bytes (%.1f%%), %.3fs CPU' % (self.messages, self.bytes_in, self.bytes_out, self.ratio() * 100, self.seconds)
+
+STATS = CompressionStats()
+
+class CompressionPolicy:
+    def __init__(self, threshold=DEFAULT_POLICY['threshold'], level=DEFAULT_POLICY['level'], deflate=DEFAULT_POLICY['deflate']):
+        self.threshold = threshold
+        self.level = level
+        self.deflate = deflate
+
+        self.key = 'zlib:%d' % level
+
+    def compress(self, data):
+        start = time.perf_counter()
+
+        compressed = zlib.compress(data, self.level)
+
+        STATS.record(len(data), len(compressed), time.perf_counter() - start)
+
+        return compressed
+
+def decompress(data):
+    return zlib.decompress(data)
+
+def is_local(host):
+    if not host or host == 'localhost':
+        return True
+
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return False
+
+    return address.is_loopback or address.is_private or address.is_link_local
+
+def get_policy(config, host):
+    config = {**DEFAULT_POLICY, **(config if config else {})}
+
+    if not config['enabled']:
+        return None
+
+    if not config['lan'] and is_local(host):
+        return None
+
+    return CompressionPolicy(threshold=config['threshold'], level=config['level'], deflate=config['deflate'])
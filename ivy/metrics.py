@@ -0,0 +1,145 @@
+import time
+import asyncio
+
+from aiohttp import web
+
+
+# name: metric, in registration order
+REGISTRY = {}
+
+def format_labels(names, values):
+    if len(names) == 0:
+        return ''
+
+    return '{%s}' % ','.join(['%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in zip(names, values)])
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    TYPE = None
+
+    def __init__(self, name, help, labels=(), collect=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+        # Optional callback returning {(label, label): value}, for values that
+        # are cheaper to read when scraped than to keep up to date.
+        self.collect = collect
+
+        self.values = {}
+
+    def key(self, labels):
+        return tuple([labels[name] for name in self.labels])
+
+    def samples(self):
+        values = self.collect() if self.collect else self.values
+
+        for key, value in values.items():
+            yield self.name, key, value
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.TYPE)]
+
+        for name, key, value in self.samples():
+            lines.append('%s%s %s' % (name, format_labels(self.labels, key), format_value(value)))
+
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    TYPE = 'gauge'
+
+    def set(self, value, **labels):
+        self.values[self.key(labels)] = value
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+
+    BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, float('inf'))
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        super().__init__(name, help, labels)
+
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+
+        if key not in self.values:
+            self.values[key] = [[0] * len(self.buckets), 0, 0]
+
+        counts, total, count = self.values[key]
+
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+
+        self.values[key][1] = total + value
+        self.values[key][2] = count + 1
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.TYPE)]
+
+        for key, (counts, total, count) in self.values.items():
+            cumulative = 0
+
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                lines.append('%s_bucket%s %d' % (self.name, format_labels(self.labels + ('le',), key + (format_value(bound),)), cumulative))
+
+            lines.append('%s_sum%s %s' % (self.name, format_labels(self.labels, key), format_value(total)))
+            lines.append('%s_count%s %d' % (self.name, format_labels(self.labels, key), count))
+
+        return '\n'.join(lines)
+
+def register(metric):
+    # Modules can be reloaded, so the first registration of a name wins.
+    if metric.name not in REGISTRY:
+        REGISTRY[metric.name] = metric
+    return REGISTRY[metric.name]
+
+def counter(name, help, labels=(), collect=None):
+    return register(Counter(name, help, labels, collect=collect))
+
+def gauge(name, help, labels=(), collect=None):
+    return register(Gauge(name, help, labels, collect=collect))
+
+def histogram(name, help, labels=(), buckets=Histogram.BUCKETS):
+    return register(Histogram(name, help, labels, buckets=buckets))
+
+def render():
+    return '\n'.join([metric.render() for metric in REGISTRY.values()]) + '\n'
+
+async def handle(request):
+    return web.Response(body=render().encode('utf-8'), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+async def serve(port, host=''):
+    # GET /metrics on its own, for processes without the relay's HTTP server.
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+
+
+loop_lag = gauge('ivy_event_loop_lag_seconds', 'How late the event loop woke up for a scheduled sleep.')
+
+async def monitor_loop_lag(interval=1):
+    while True:
+        start = time.perf_counter()
+
+        await asyncio.sleep(interval)
+
+        loop_lag.set(max(0, time.perf_counter() - start - interval))
@@ -52,6 +52,9 @@ class MinerHardware:
 
 class GPUStats:
     def __init__(self, **kwargs):
+        # Tells the cards of a machine apart in the statistics history.
+        self.bus_id = kwargs['bus_id'] if 'bus_id' in kwargs else None
+
         self.update(**kwargs)
 
     def update(self, **kwargs):
@@ -65,6 +68,7 @@ class GPUStats:
     def as_obj(self):
         obj = {}
 
+        if self.bus_id is not None: obj['bus_id'] = self.bus_id
         if self.status is not None: obj['status'] = self.status
         if self.watts is not None: obj['watts'] = self.watts
         if self.temp is not None: obj['temp'] = self.temp
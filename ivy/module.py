@@ -1,3 +1,5 @@
+import os
+
 from ivy.net import NetConnector
 
 class Module:
@@ -9,7 +11,11 @@ class Module:
 
         if not hasattr(self, 'IS_RELAY') or not self.IS_RELAY:
             self.relay_priority = None
-            self.connector = NetConnector(self.logger.getChild('socket'))
+            # Wire codecs to offer the relay, most preferred first.
+            self.connector = NetConnector(self.logger.getChild('socket'),
+                                            codecs=self.config['codecs'] if 'codecs' in self.config else None,
+                                            compression=self.config['compression'] if 'compression' in self.config else None,
+                                            limits=self.config['websocket'] if 'websocket' in self.config else None)
             self.connector.listen_event('connection', 'open')(self.event_connection_open)
             self.connector.listen_event('connection', 'closed')(self.event_connection_closed)
 
@@ -32,6 +38,24 @@ class Module:
     def on_connect_relay(self, service):
         pass
 
+    def open_relay(self, service, extra_headers=None):
+        # The relay is a module of this very process. Packets are handed to it
+        # directly, without being serialized.
+        if service.payload['id'] == self.ivy.id:
+            for module in self.ivy.modules.values():
+                if hasattr(module, 'IS_RELAY') and module.IS_RELAY and hasattr(module, 'service'):
+                    self.connector.open(service.ip, service.port, extra_headers, loopback=module.service.listener)
+                    return
+
+        # A relay with the same Ivy ID is running on this machine. Its Unix
+        # socket skips the TCP stack entirely.
+        path = service.payload['socket'] if 'socket' in service.payload else None
+
+        if path is not None and (service.payload['id'] != self.ivy.id or not os.path.exists(path)):
+            path = None
+
+        self.connector.open(service.ip, service.port, extra_headers, path=path)
+
     def on_load(self):
         pass
 
@@ -1,37 +1,201 @@
-import json
+import os
+import time
+import socket
+import uuid
 import asyncio
+import functools
 import traceback
 import urllib.parse
 
 import websockets
 from websockets.exceptions import ConnectionClosed
 
+from ivy.codec import Body, Frame, JSON, PREFERRED_CODECS, negotiate
+from ivy.compression import STATS as COMPRESSION_STATS, get_policy
+
+
+# Passed straight to websockets. max_size * max_queue bounds what a single
+# connection can buffer on the way in, write_limit on the way out.
+WEBSOCKET_LIMITS = {
+    'max_size': 2 ** 23,
+    'max_queue': 8,
+    'read_limit': 2 ** 16,
+    'write_limit': 2 ** 16
+}
+
+# Per role, see NetListener.heartbeat. Peers that have been quiet for
+# `interval` seconds are pinged, and dropped once nothing at all has been
+# heard from them for `timeout` seconds. None turns it off.
+HEARTBEATS = {
+    'miner': {'interval': 5, 'timeout': 15},
+    'other': {'interval': 15, 'timeout': 45}
+}
+
 
 class SocketWrapper:
-    def __init__(self, ws):
+    def __init__(self, ws, codec=None, compression=None):
         self.id = ws.__hash__()
         self.ws = ws
 
+        self.codec = codec if codec is not None else JSON
+        self.compression = compression
+
+        self.last_seen = time.monotonic()
+
     def open(self):
         return self.ws.open
 
+    def seen(self):
+        self.last_seen = time.monotonic()
+
     async def recv(self):
-        return json.loads(await self.ws.recv())
+        # Only the routing header is decoded here. The payload stays in the
+        # returned body until a listener actually reads it.
+        data = await self.ws.recv()
+        self.seen()
+
+        header, body = self.codec.unpack(data)
+        body.size = len(data)
 
-    def close(self):
-        self.ws.close()
+        return header, body
+
+    def close(self, code=1000):
+        return asyncio.ensure_future(self.ws.close(code))
 
     async def send(self, event, method, payload=None, to=None, sender=None):
-        packet = {'event': event, 'method': method}
+        await self.send_frame(Frame(event, method, Body(payload), to=to, sender=sender))
+
+    async def send_frame(self, frame):
+        await self.ws.send(frame.encode(self.codec, self.compression))
+
+    @staticmethod
+    async def broadcast(sockets, event, method, payload=None, to=None, sender=None):
+        frame = Frame(event, method, Body(payload), to=to, sender=sender)
+
+        results = await asyncio.gather(*[socket.send_frame(frame) for socket in sockets], return_exceptions=True)
+
+        return [socket for socket, result in zip(sockets, results) if isinstance(result, Exception)]
+
+class LoopbackClosed(ConnectionClosed):
+    # Raised by a closed LoopbackSocket, so it's handled like a websocket
+    # that went away.
+    code = 1001
+    reason = ''
+
+    def __init__(self):
+        Exception.__init__(self, 'loopback closed')
+
+    def __str__(self):
+        return 'loopback closed'
+
+class LoopbackSocket(SocketWrapper):
+    # One end of a connection between a NetConnector and a NetListener in the
+    # same process. Frames are handed to the other end as they are, so
+    # payloads are never serialized, and nothing goes through the kernel.
+    def __init__(self):
+        self.id = self.__hash__()
+        self.ws = None
+
+        # No wire format at all
+        self.codec = None
+        self.compression = None
+
+        self.last_seen = time.monotonic()
+
+        # Bounded like a websocket's, so a slow reader backs up the sender.
+        self.queue = asyncio.Queue(maxsize=WEBSOCKET_LIMITS['max_queue'])
+        self.peer = None
+
+        self.closed = False
+
+    @staticmethod
+    def pair():
+        a, b = LoopbackSocket(), LoopbackSocket()
+        a.peer, b.peer = b, a
+        return a, b
+
+    def open(self):
+        return not self.closed
+
+    async def recv(self):
+        frame = await self.queue.get()
+
+        if frame is None:
+            raise LoopbackClosed()
+
+        self.seen()
+
+        return frame.header(), frame.body
+
+    def close(self, code=1000):
+        # Closes both ends, like a websocket would.
+        # Frames nobody read yet are dropped to make room for the close.
+        for socket in [self, self.peer]:
+            if not socket.closed:
+                socket.closed = True
+
+                while socket.queue.full():
+                    socket.queue.get_nowait()
+                socket.queue.put_nowait(None)
+
+    async def send_frame(self, frame):
+        if self.closed:
+            raise LoopbackClosed()
+
+        await self.peer.queue.put(frame)
+
+class PolicyServerProtocol(websockets.WebSocketServerProtocol):
+    # Only accepts permessage-deflate where the compression policy for the
+    # peer's role and address allows it, and only for plain JSON. The other
+    # codecs already compress their payloads. Browsers always ask for it.
+    def __init__(self, *args, policies=None, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # role: compression policy config
+        self.policies = policies
+
+    def process_extensions(self, headers, available_extensions):
+        role = 'miner' if 'Miner-ID' in headers else 'other'
+        host = self.remote_address[0] if isinstance(self.remote_address, tuple) else None
+
+        policy = get_policy(self.policies[role], host)
+
+        if policy is None or not policy.deflate or negotiate(headers.get('Codec')) is not JSON:
+            available_extensions = None
 
-        if sender: packet['from'] = sender
-        if to: packet['to'] = to
-        if payload: packet['payload'] = payload
+        header, extensions = super().process_extensions(headers, available_extensions)
 
-        await self.ws.send(json.dumps(packet))
+        for extension in extensions:
+            extension.encode = timed_encode(extension.encode)
+
+        return header, extensions
+
+def timed_encode(encode):
+    # Counts what permessage-deflate compresses along with our own payloads.
+    def inner(frame):
+        start = time.perf_counter()
+        encoded = encode(frame)
+
+        if encoded is not frame:
+            COMPRESSION_STATS.record(len(frame.data), len(encoded.data), time.perf_counter() - start)
+
+        return encoded
+    return inner
+
+def unix_socket_alive(path):
+    # Whether something still accepts connections on `path`, as opposed to
+    # a file left behind by a process that is gone.
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+        return True
+    except OSError:
+        return False
+    finally:
+        s.close()
 
 class Packet:
-    def __init__(self, socket, event, method, payload=None, to=None, **kwargs):
+    def __init__(self, socket, event, method, payload=None, to=None, body=None, **kwargs):
         self.dummy = kwargs['dummy'] if 'dummy' in kwargs else False
 
         self.socket = socket
@@ -42,7 +206,18 @@ class Packet:
         self.method = method
 
         self.to = to
-        self.payload = payload
+        self.body = body if body is not None else Body(payload)
+
+        # Set when this packet is part of a request, see Net.request
+        self.rpc = kwargs['rpc'] if 'rpc' in kwargs else None
+
+    @property
+    def payload(self):
+        return self.body.payload
+
+    @payload.setter
+    def payload(self, payload):
+        self.body = Body(payload)
 
     async def send(self, *args, **kwargs):
         await self.socket.send(*args, **kwargs)
@@ -50,6 +225,14 @@ class Packet:
     async def reply(self, *args, **kwargs):
         await self.socket.send(*args, **kwargs, to=self.sender)
 
+    async def respond(self, op, payload=None):
+        await self.socket.send_frame(Frame(self.event, self.method, Body(payload), to=self.sender, rpc={'id': self.rpc['id'], 'op': op}))
+
+    async def stream(self, payload):
+        # Sends part of the result of a request. The listener's return value
+        # still finishes it off.
+        await self.respond('chunk', payload)
+
     def __repr__(self):
         return str({
             'event': self.event,
@@ -58,88 +241,326 @@ class Packet:
             'payload': self.payload
         })
 
+# How many concurrent listeners (see Net.listen_event) may run at once
+# before new packets have to wait for one to finish.
+MAX_CONCURRENT_LISTENERS = 8
+
+# Seconds to wait for a request's result, unless told otherwise
+REQUEST_TIMEOUT = 30
+
+class RequestError(Exception):
+    pass
+
 class Net:
-    def __init__(self, logger):
+    def __init__(self, logger, max_concurrent=MAX_CONCURRENT_LISTENERS, rpc=True):
         self.logger = logger
 
+        # Whether requests are answered and replies are picked up here. The
+        # relay turns this off, it only ever passes them along.
+        self.rpc = rpc
+
+        # id: queue of reply packets, for requests we sent
+        self.calls = {}
+
+        # (sender, id): task, for requests we're answering
+        self.answering = {}
+
+        # event: {method: [(listener, concurrent), ...]}
         self.events = {}
 
+        # (event, method): ((listener, concurrent), ...), wildcards already merged in
+        self.dispatch = {}
+
+        self.max_concurrent = max_concurrent
+        self.semaphore = None
+        self.running = set()
+
         self.task = None
 
-    def listen_event(self, listen, method=None):
+    def listen_event(self, listen, method=None, concurrent=False):
+        # Concurrent listeners run in their own task, so a slow one doesn't hold
+        # up the listeners after it, or the next packets from the socket.
         if method is None: method = '*'
 
         if callable(listen):
-            return self.listen_event('*', method)(listen)
+            return self.listen_event('*', method, concurrent=concurrent)(listen)
         else:
             if listen not in self.events: self.events[listen] = {}
             if method not in self.events[listen]: self.events[listen][method] = []
 
         def inner(func):
-            def unregister(self):
-                self.events[listen][method].remove(func)
+            def unregister():
+                self.unregister_event(func, listen, method)
             func.__dict__['unregister_event'] = unregister
-            self.events[listen][method].append(func)
+            self.events[listen][method].append((func, concurrent))
+            self.dispatch.clear()
             return func
         return inner
 
+    def unregister_event(self, func, listen='*', method='*'):
+        self.events[listen][method] = [x for x in self.events[listen][method] if x[0] != func]
+        self.dispatch.clear()
+
+    def listeners(self, event, method):
+        # Names nobody listens for specifically share the '*' entry, so
+        # made-up names can't grow the cache.
+        if event not in self.events:
+            event = '*'
+        if method not in self.events.get(event, {}) and method not in self.events.get('*', {}):
+            method = '*'
+
+        key = (event, method)
+
+        if key not in self.dispatch:
+            listeners = []
+
+            for e in dict.fromkeys([event, '*']):
+                if e in self.events:
+                    for m in dict.fromkeys([method, '*']):
+                        if m in self.events[e]:
+                            listeners.extend(self.events[e][m])
+
+            self.dispatch[key] = tuple(listeners)
+        return self.dispatch[key]
+
     async def call_event(self, packet):
-        if packet.event in self.events:
-            if packet.method in self.events[packet.event]:
-                for listener in self.events[packet.event][packet.method]:
-                    try:
-                        await listener(packet)
-                    except:
-                        self.logger.exception(traceback.format_exc())
+        if self.rpc and packet.rpc is not None:
+            await self.call_rpc(packet)
+            return
 
-            if '*' in self.events[packet.event]:
-                for listener in self.events[packet.event]['*']:
-                    try:
-                        await listener(packet)
-                    except:
-                        self.logger.exception(traceback.format_exc())
+        for listener, concurrent in self.listeners(packet.event, packet.method):
+            if concurrent:
+                await self.spawn(listener, packet)
+                continue
 
-        if '*' in self.events:
-            if packet.method in self.events['*']:
-                for listener in self.events['*'][packet.method]:
-                    try:
-                        await listener(packet)
-                    except:
-                        self.logger.exception(traceback.format_exc())
+            try:
+                await listener(packet)
+            except:
+                self.logger.exception(traceback.format_exc())
 
-            if '*' in self.events['*']:
-                for listener in self.events['*']['*']:
-                    try:
-                        await listener(packet)
-                    except:
-                        self.logger.exception(traceback.format_exc())
+    async def spawn(self, listener, packet):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrent)
+
+        # Waits here once too many are already running, which in turn stops
+        # the socket from reading any further.
+        await self.semaphore.acquire()
+
+        task = asyncio.ensure_future(self.run_concurrent(listener, packet))
+        self.running.add(task)
+        task.add_done_callback(self.running.discard)
+
+    async def run_concurrent(self, listener, packet):
+        try:
+            await listener(packet)
+        except asyncio.CancelledError:
+            pass
+        except:
+            self.logger.exception(traceback.format_exc())
+        finally:
+            self.semaphore.release()
+
+    async def request(self, event, method, payload=None, to='one', timeout=REQUEST_TIMEOUT, socket=None):
+        # Sends a request and waits for its result: whatever the other side's
+        # listener returned. Timing out or being cancelled cancels the listener too.
+        result = None
+
+        async for op, payload in self.call(event, method, payload, to=to, timeout=timeout, socket=socket):
+            if op == 'done':
+                result = payload
+
+        return result
+
+    async def stream(self, event, method, payload=None, to='one', timeout=REQUEST_TIMEOUT, socket=None):
+        # Like request, but yields every chunk the listener streams back,
+        # followed by its return value (if any).
+        call = self.call(event, method, payload, to=to, timeout=timeout, socket=socket)
+
+        try:
+            async for op, payload in call:
+                if op == 'chunk' or payload is not None:
+                    yield payload
+        finally:
+            # Stopping early cancels the listener.
+            await call.aclose()
+
+    async def call(self, event, method, payload=None, to='one', timeout=REQUEST_TIMEOUT, socket=None):
+        if socket is None: socket = self.socket
+
+        id = uuid.uuid4().hex
+        self.calls[id] = asyncio.Queue()
+
+        deadline = asyncio.get_event_loop().time() + timeout if timeout is not None else None
+
+        finished = False
+        responder = to
+
+        try:
+            await socket.send_frame(Frame(event, method, Body(payload), to=to, rpc={'id': id, 'op': 'call', 'timeout': timeout}))
+
+            while True:
+                remaining = deadline - asyncio.get_event_loop().time() if deadline is not None else None
+
+                packet = await asyncio.wait_for(self.calls[id].get(), remaining)
+
+                # Cancels should go to whoever picked the request up.
+                if packet.sender is not None: responder = packet.sender
+
+                op = packet.rpc['op']
+
+                if op == 'error':
+                    finished = True
+                    raise RequestError(packet.payload['message'] if packet.payload else 'Request failed.')
+
+                if op == 'done':
+                    finished = True
+
+                yield op, packet.payload
+
+                if finished:
+                    return
+        finally:
+            del self.calls[id]
+
+            if not finished:
+                try:
+                    await socket.send_frame(Frame(event, method, to=responder, rpc={'id': id, 'op': 'cancel'}))
+                except Exception:
+                    pass
+
+    async def call_rpc(self, packet):
+        op = packet.rpc['op'] if 'op' in packet.rpc else None
+        key = (packet.sender, packet.rpc['id'] if 'id' in packet.rpc else None)
+
+        if op == 'call':
+            task = asyncio.ensure_future(self.answer(packet))
+            self.answering[key] = task
+            task.add_done_callback(lambda task: self.answering.pop(key, None))
+        elif op == 'cancel':
+            if key in self.answering:
+                self.answering[key].cancel()
+        elif key[1] in self.calls:
+            self.calls[key[1]].put_nowait(packet)
+
+    async def answer(self, packet):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrent)
+
+        # Waits for a slot here and not in call_rpc, so the socket keeps
+        # reading cancels (and everything else) while all of them are busy.
+        await self.semaphore.acquire()
+
+        try:
+            timeout = packet.rpc['timeout'] if 'timeout' in packet.rpc else None
+
+            result = await asyncio.wait_for(self.invoke(packet), timeout)
+
+            await packet.respond('done', result)
+        except asyncio.CancelledError:
+            pass
+        except asyncio.TimeoutError:
+            await packet.respond('error', {'message': 'Deadline exceeded.'})
+        except Exception as e:
+            self.logger.exception(traceback.format_exc())
+
+            try:
+                await packet.respond('error', {'message': str(e)})
+            except Exception:
+                pass
+        finally:
+            self.semaphore.release()
+
+    async def invoke(self, packet):
+        result = None
+
+        for listener, concurrent in self.listeners(packet.event, packet.method):
+            value = await listener(packet)
+
+            if result is None:
+                result = value
+
+        return result
 
 class NetListener(Net):
-    def __init__(self, logger):
-        super(NetListener, self).__init__(logger)
+    def __init__(self, logger, compression=None, limits=None, heartbeats=None, rpc=True):
+        super(NetListener, self).__init__(logger, rpc=rpc)
 
         self.connections = {}
 
+        self.limits = {**WEBSOCKET_LIMITS, **(limits if limits else {})}
+
+        # role: compression policy config, see ivy.compression.DEFAULT_POLICY
+        self.compression = {'miner': {}, 'other': {}}
+        if compression: self.compression.update(compression)
+
+        # role: {interval, timeout}
+        self.heartbeats = {role: {**HEARTBEATS[role], **(heartbeats[role] if heartbeats and role in heartbeats else {})} for role in HEARTBEATS}
+
     def serve(self, host, port):
-        self.task = asyncio.ensure_future(websockets.serve(self.listener, host, port))
+        # permessage-deflate is offered, then accepted per connection by PolicyServerProtocol.
+        protocol = functools.partial(PolicyServerProtocol, policies=self.compression)
+
+        # websockets' own keepalive is the same for every connection. heartbeat() replaces it.
+        self.task = asyncio.ensure_future(websockets.serve(self.listener, host, port, extra_headers=self.response_headers, create_protocol=protocol,
+                                                            compression='deflate', ping_interval=None, **self.limits))
+
+    def serve_unix(self, path):
+        # Same as serve(), for modules on this machine. No compression, since
+        # nothing here ever leaves the box.
+        if os.path.exists(path):
+            if unix_socket_alive(path):
+                self.logger.warning('Another relay is already listening on %s. Not taking it over.' % path)
+                return False
+
+            os.remove(path)
+
+        self.unix_task = asyncio.ensure_future(websockets.unix_serve(self.listener, path, extra_headers=self.response_headers,
+                                                                    compression=None, ping_interval=None, **self.limits))
+        return True
+
+    def response_headers(self, path, request_headers):
+        if 'Codec' in request_headers:
+            return {'Codec': negotiate(request_headers['Codec']).name}
+        return {}
 
     async def listener(self, ws, path):
-        socket = SocketWrapper(ws)
+        role = 'miner' if 'Miner-ID' in ws.request_headers else 'other'
+        host = ws.remote_address[0] if isinstance(ws.remote_address, tuple) else None
+
+        socket = SocketWrapper(ws, codec=negotiate(ws.request_headers.get('Codec')), compression=get_policy(self.compression[role], host))
+
+        # items() lowercases the names, which are looked up as sent.
+        headers = {k: v for k, v in ws.request_headers.raw_items()}
 
-        headers = {k: v for k, v in ws.request_headers.items()}
+        await self.handle(socket, headers, path, heartbeat=self.heartbeats[role])
 
+    def connect_loopback(self, extra_headers=None, path='/'):
+        # Accepts a connection from a NetConnector in this process, see
+        # NetConnector.open. Returns the connector's end of it.
+        local, remote = LoopbackSocket.pair()
+
+        # Header values are strings on the wire, too.
+        headers = {k: v if isinstance(v, str) else str(v) for k, v in (extra_headers if extra_headers else {}).items()}
+
+        asyncio.ensure_future(self.handle(remote, headers, path))
+
+        return local
+
+    async def handle(self, socket, headers, path, heartbeat=None):
         await self.call_event(Packet(socket, 'connection', 'open', payload={'headers': headers, 'path': urllib.parse.unquote(path)}, dummy=True))
 
+        heartbeat = asyncio.ensure_future(self.heartbeat(socket, **(heartbeat if heartbeat else {})))
+
         try:
             while True:
-                data = await socket.recv()
+                header, body = await socket.recv()
 
-                if 'event' in data and 'method' in data:
-                    packet = Packet(socket, **data)
+                if 'event' in header and 'method' in header:
+                    packet = Packet(socket, body=body, **header)
                     packet.sender = socket.id
                     await self.call_event(packet)
                 else:
-                    self.logger.warning('Unknown data received: %r' % data)
+                    self.logger.warning('Unknown data received: %r' % header)
         except ConnectionClosed as e:
             if e.code != 1001 and e.code != 1006:
                 self.logger.exception(traceback.format_exc())
@@ -147,41 +568,110 @@ class NetListener(Net):
             self.logger.critical('Socket connection closed!')
             self.logger.exception('\n' + traceback.format_exc())
         finally:
+            heartbeat.cancel()
+
             await self.call_event(Packet(socket, 'connection', 'closed', payload={'headers': headers, 'path': urllib.parse.unquote(path)}, dummy=True))
 
+    async def heartbeat(self, socket, interval=None, timeout=None):
+        # A rig that loses power never closes its side, and TCP can take a
+        # long time to notice. Anything received counts, pongs included.
+        if not interval or not timeout:
+            return
+
+        ping = None
+
+        try:
+            while True:
+                idle = time.monotonic() - socket.last_seen
+
+                if idle >= timeout:
+                    self.logger.warning('Nothing heard from %r in %.0fs. Dropping it.' % (socket.id, idle))
+
+                    # Ends the recv() in listener right away. A closing handshake
+                    # would wait on a peer that is most likely gone.
+                    socket.ws.transport.abort()
+                    return
+
+                # In its own task, so the deadline doesn't wait on the ping
+                # being written to a peer that stopped reading.
+                if idle >= interval and (ping is None or ping.done()):
+                    ping = asyncio.ensure_future(self.ping(socket))
+
+                await asyncio.sleep(min(interval, timeout - idle) if idle >= interval else interval - idle)
+        except ConnectionClosed:
+            pass
+        finally:
+            if ping is not None:
+                ping.cancel()
+
+    async def ping(self, socket):
+        try:
+            pong = await socket.ws.ping()
+            await pong
+
+            socket.seen()
+        except ConnectionClosed:
+            pass
+
 class NetConnector(Net):
-    def __init__(self, logger):
+    def __init__(self, logger, codecs=None, compression=None, limits=None):
         super(NetConnector, self).__init__(logger)
 
+        self.limits = {**WEBSOCKET_LIMITS, **(limits if limits else {})}
+
         self.socket = None
 
-    def open(self, host, port, extra_headers=None):
-        self.task = asyncio.ensure_future(self.listener(host, port, extra_headers=extra_headers))
+        self.codecs = codecs if codecs is not None else PREFERRED_CODECS
+        self.compression = compression
+
+    def open(self, host, port, extra_headers=None, path=None, loopback=None):
+        # With `path`, the relay is reached through its Unix socket instead of TCP.
+        # With `loopback`, a NetListener in this process, it's reached directly.
+        self.task = asyncio.ensure_future(self.listener(host, port, extra_headers=extra_headers, path=path, loopback=loopback))
 
     async def close(self):
         self.task.cancel()
         with suppress(asyncio.CancelledError):
             await self.task
 
-    async def listener(self, host, port, extra_headers=None):
+    async def listener(self, host, port, extra_headers=None, path=None, loopback=None):
         try:
             uri = 'ws://%s:%d/' % (host, port)
 
-            self.logger.debug('Connecting to %s...' % uri)
+            self.logger.debug('Connecting to %s...' % (uri if path is None else path) if loopback is None else 'Connecting to the relay in this process...')
+
+            headers = {'Codec': ', '.join(self.codecs)}
+            if extra_headers: headers.update(extra_headers)
+
+            compression = get_policy(self.compression, host if path is None else None)
+
+            # The other codecs compress their own payloads, see PolicyServerProtocol.
+            deflate = 'deflate' if compression and compression.deflate and negotiate(headers['Codec']) is JSON else None
 
             try:
-                async with websockets.connect(uri, extra_headers=extra_headers) as ws:
-                    self.socket = SocketWrapper(ws)
+                if loopback is not None:
+                    await self.receive(loopback.connect_loopback(extra_headers))
+                else:
+                    ws = None
+
+                    if path is not None:
+                        try:
+                            ws = await websockets.unix_connect(path, uri, extra_headers=headers, compression=deflate, **self.limits)
+                        except OSError as e:
+                            # Left behind by a relay that is gone, or not ours to use.
+                            self.logger.warning('Relay socket %s is unusable (%r). Connecting over TCP instead.' % (path, e))
 
-                    await self.call_event(Packet(self.socket, 'connection', 'open', dummy=True))
+                            compression = get_policy(self.compression, host)
+                            deflate = 'deflate' if compression and compression.deflate and negotiate(headers['Codec']) is JSON else None
 
-                    while True:
-                        data = await self.socket.recv()
+                    if ws is None:
+                        ws = await websockets.connect(uri, extra_headers=headers, compression=deflate, **self.limits)
 
-                        if 'event' in data and 'method' in data:
-                            await self.call_event(Packet(self.socket, **data))
-                        else:
-                            self.logger.warning('Unknown data received: %r' % data)
+                    try:
+                        # Relays that don't know about codecs won't answer, and expect plain JSON.
+                        await self.receive(SocketWrapper(ws, codec=negotiate(ws.response_headers.get('Codec')), compression=compression))
+                    finally:
+                        await ws.close()
             except ConnectionClosed as e:
                 if e.code != 1001 and e.code != 1006:
                     raise e
@@ -192,3 +682,16 @@ class NetConnector(Net):
             await self.call_event(Packet(self.socket, 'connection', 'closed', dummy=True))
         
         self.socket = None
+
+    async def receive(self, socket):
+        self.socket = socket
+
+        await self.call_event(Packet(self.socket, 'connection', 'open', dummy=True))
+
+        while True:
+            header, body = await self.socket.recv()
+
+            if 'event' in header and 'method' in header:
+                await self.call_event(Packet(self.socket, body=body, **header))
+            else:
+                self.logger.warning('Unknown data received: %r' % header)
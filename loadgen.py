@@ -0,0 +1,382 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import urllib.parse
+import resource
+import subprocess
+
+import websockets
+
+from ivy.net import NetConnector, SocketWrapper
+
+
+# Subscriptions as sent by the real client module and the dashboard.
+MINER_SUBSCRIPTIONS = {'machine': ['action'], 'fee': ['update']}
+DASHBOARD_SUBSCRIPTIONS = {'machines': ['*'], 'machine': ['*'], 'messages': ['*'], 'stats': ['response'],
+                            'coins': ['*'], 'tickers': ['*'], 'software': ['*'], 'fee': ['*']}
+
+def percentile(samples, p):
+    if len(samples) == 0:
+        return 0
+
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+def rss(pid):
+    # Resident memory of a process in bytes, or None if it can't be read.
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+class Stats:
+    def __init__(self):
+        self.sent = {}
+        self.received = {}
+        self.bytes = 0
+
+        # path: [seconds, seconds, seconds]
+        self.latency = {}
+
+        self.connected = {'miner': 0, 'dashboard': 0}
+        self.failed = 0
+
+    def count(self, counts, event, method):
+        key = '%s %s' % (event, method)
+        counts[key] = counts.get(key, 0) + 1
+
+    def observe(self, path, seconds):
+        if path not in self.latency: self.latency[path] = []
+        self.latency[path].append(seconds)
+
+    def pop(self):
+        # Returns everything counted since the last call, and starts over.
+        sent, received, bytes, latency = self.sent, self.received, self.bytes, self.latency
+
+        self.sent, self.received, self.bytes, self.latency = {}, {}, 0, {}
+
+        return sent, received, bytes, latency
+
+class Fleet:
+    def __init__(self, args):
+        self.args = args
+
+        self.stats = Stats()
+        self.logger = logging.getLogger('loadgen')
+
+        # machine id: when its newest stats were sent
+        self.stats_sent = {}
+
+        # machine id: when an action for it was sent
+        self.actions_sent = {}
+
+        self.miners = {}
+        self.dashboards = []
+
+        # Started by --spawn-relay
+        self.relay = None
+
+    def gpus(self, count):
+        return [{'bus_id': '%02x:00.0' % i, 'status': {'type': 'online'}, 'watts': random.randint(90, 180), 'temp': random.randint(45, 80),
+                    'fan': random.randint(30, 100), 'rate': random.uniform(20e6, 35e6)} for i in range(count)]
+
+    async def miner(self, machine_id):
+        connector = NetConnector(self.logger.getChild(machine_id), codecs=self.args.codecs)
+        connected = asyncio.Event()
+
+        @connector.listen_event('connection', 'open')
+        async def event(packet):
+            self.stats.connected['miner'] += 1
+            connected.set()
+
+            await self.send(packet.socket, 'machines', 'update', {machine_id: {
+                'hardware': {'gpus': [{'bus_id': '%02x:00.0' % i, 'vendor': 'NVIDIA', 'product': 'Simulated'} for i in range(self.args.gpus)]},
+                'config': {}
+            }})
+
+        @connector.listen_event('connection', 'closed')
+        async def event(packet):
+            if connected.is_set():
+                self.stats.connected['miner'] -= 1
+            else:
+                self.stats.failed += 1
+            connected.set()
+
+        @connector.listen_event('machine', 'action')
+        async def event(packet):
+            self.stats.count(self.stats.received, packet.event, packet.method)
+
+            if machine_id in self.actions_sent:
+                self.stats.observe('machines action -> machine action', time.perf_counter() - self.actions_sent.pop(machine_id))
+
+            if packet.payload['id'] == 'refresh':
+                await self.send(packet.socket, 'machines', 'update', {machine_id: {'config': packet.payload['config']}})
+
+        connector.open(self.args.host, self.args.port, {'Miner-ID': machine_id, 'Subscribe': json.dumps(MINER_SUBSCRIPTIONS)})
+
+        await connected.wait()
+
+        self.miners[machine_id] = connector
+
+        asyncio.ensure_future(self.monitor(machine_id, connector))
+
+    async def monitor(self, machine_id, connector):
+        # Same cadence as the client's Monitor.on_update: a tick every 5
+        # seconds, with stats sent when something changed, or every 60.
+        gpus = self.gpus(self.args.gpus)
+
+        last_update = 0
+
+        # Spread the fleet out, like miners that were started at different times.
+        await asyncio.sleep(random.uniform(0, self.args.tick))
+
+        while connector.socket is not None:
+            update = random.random() < self.args.change or time.time() - last_update > self.args.refresh
+
+            if update:
+                last_update = time.time()
+
+                for gpu in gpus:
+                    gpu['temp'] = max(30, min(90, gpu['temp'] + random.randint(-2, 2)))
+                    gpu['rate'] = gpu['rate'] * random.uniform(.98, 1.02)
+
+                self.stats_sent[machine_id] = time.perf_counter()
+
+                await self.send(connector.socket, 'machines', 'new_stats', {machine_id: {
+                    'status': {'type': 'mining', 'fee': False},
+                    'shares': {'accepted': random.randint(0, 3), 'rejected': 0, 'invalid': 0},
+                    'hardware': {'gpus': gpus}
+                }})
+
+            await asyncio.sleep(self.args.tick)
+
+    async def dashboard(self, index):
+        # Browsers only speak plain JSON, and can't set headers.
+        try:
+            ws = await websockets.connect('ws://%s:%d/?subscribe=%s' % (self.args.host, self.args.port, urllib.parse.quote(json.dumps(DASHBOARD_SUBSCRIPTIONS))),
+                                            max_size=None)
+        except Exception:
+            self.stats.failed += 1
+            return
+
+        socket = SocketWrapper(ws)
+
+        self.stats.connected['dashboard'] += 1
+        self.dashboards.append(socket)
+
+        for thing in ['machines', 'messages', 'coins', 'fee']:
+            await self.send(socket, thing, 'get', to='one')
+
+        try:
+            while True:
+                header, body = await socket.recv()
+
+                self.stats.count(self.stats.received, header['event'], header['method'])
+                self.stats.bytes += body.size if body.size else 0
+
+                if header['event'] == 'machines' and header['method'] in ['new_stats', 'stats'] and isinstance(body.payload, dict):
+                    now = time.perf_counter()
+
+                    for machine_id in body.payload:
+                        if machine_id in self.stats_sent:
+                            self.stats.observe('machines new_stats -> %s %s' % (header['event'], header['method']), now - self.stats_sent[machine_id])
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self.stats.connected['dashboard'] -= 1
+            self.dashboards.remove(socket)
+
+    async def actions(self):
+        # Dashboards patching random machines, which compute turns into a
+        # 'machine action' for the miner.
+        if self.args.actions <= 0:
+            return
+
+        while True:
+            await asyncio.sleep(1 / self.args.actions)
+
+            if len(self.dashboards) == 0 or len(self.miners) == 0:
+                continue
+
+            machine_id = random.choice(list(self.miners))
+            self.actions_sent[machine_id] = time.perf_counter()
+
+            await self.send(random.choice(self.dashboards), 'machines', 'action', {machine_id: {'id': 'patch'}})
+
+    async def send(self, socket, event, method, payload=None, to=None):
+        self.stats.count(self.stats.sent, event, method)
+
+        await socket.send(event, method, payload, to=to)
+
+    async def connect(self):
+        # Ramps up instead of opening everything at once, like a farm
+        # coming back online.
+        tasks = []
+
+        for i in range(self.args.miners):
+            tasks.append(asyncio.ensure_future(self.miner('sim-%06d' % i)))
+
+            if self.args.ramp > 0 and i % self.args.ramp == self.args.ramp - 1:
+                await asyncio.sleep(1)
+
+        for i in range(self.args.dashboards):
+            asyncio.ensure_future(self.dashboard(i))
+
+        await asyncio.gather(*tasks)
+
+    def report(self, elapsed, final=False):
+        sent, received, bytes, latency = self.stats.pop()
+
+        connections = self.stats.connected['miner'] + self.stats.connected['dashboard']
+
+        print('--- %s %.0fs: %d miners, %d dashboards, %d failed' % ('total' if final else 'last', elapsed,
+                    self.stats.connected['miner'], self.stats.connected['dashboard'], self.stats.failed))
+
+        print('%-40s %12s %12s' % ('', 'sent/s', 'received/s'))
+        for key in sorted(set(sent) | set(received)):
+            print('%-40s %12.1f %12.1f' % (key, sent.get(key, 0) / elapsed, received.get(key, 0) / elapsed))
+        print('%-40s %12s %10.1fKB' % ('dashboard bytes/s', '', bytes / elapsed / 1024))
+
+        if len(latency) > 0:
+            print('%-40s %9s %9s %9s %9s %9s' % ('latency (ms)', 'count', 'p50', 'p90', 'p99', 'max'))
+            for path, samples in sorted(latency.items()):
+                samples.sort()
+                print('%-40s %9d %9.2f %9.2f %9.2f %9.2f' % (path, len(samples), percentile(samples, 50) * 1000,
+                        percentile(samples, 90) * 1000, percentile(samples, 99) * 1000, samples[-1] * 1000))
+
+        for name, pid, baseline in [('relay', self.args.relay_pid, self.relay_rss), ('compute', self.args.compute_pid, self.compute_rss)]:
+            if pid is None: continue
+
+            memory = rss(pid)
+            if memory is None: continue
+
+            line = '%-40s %10.1fMB' % (name + ' rss', memory / 1024 / 1024)
+            if baseline is not None and connections > 0:
+                line += ' (%.1fKB per connection)' % ((memory - baseline) / connections / 1024)
+            print(line)
+
+        print('%-40s %10.1fMB' % ('loadgen rss', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+    async def run(self):
+        self.relay_rss = rss(self.args.relay_pid) if self.args.relay_pid else None
+        self.compute_rss = rss(self.args.compute_pid) if self.args.compute_pid else None
+
+        start = time.perf_counter()
+
+        await self.connect()
+
+        print('Connected %d miners in %.1fs.' % (len(self.miners), time.perf_counter() - start))
+
+        asyncio.ensure_future(self.actions())
+
+        # Only what happens once everything is connected is counted.
+        self.stats.pop()
+        start = last = time.perf_counter()
+
+        totals = Stats()
+
+        while time.perf_counter() - start < self.args.duration:
+            await asyncio.sleep(min(self.args.report, self.args.duration - (time.perf_counter() - start)))
+
+            now = time.perf_counter()
+
+            sent, received, bytes, latency = self.stats.sent, self.stats.received, self.stats.bytes, self.stats.latency
+
+            for key, count in sent.items(): totals.sent[key] = totals.sent.get(key, 0) + count
+            for key, count in received.items(): totals.received[key] = totals.received.get(key, 0) + count
+            for path, samples in latency.items(): totals.latency.setdefault(path, []).extend(samples)
+            totals.bytes += bytes
+
+            self.report(now - last)
+            last = now
+
+        self.stats.sent, self.stats.received, self.stats.bytes, self.stats.latency = totals.sent, totals.received, totals.bytes, totals.latency
+        self.report(time.perf_counter() - start, final=True)
+
+        # Before the connections are dropped, so it doesn't log every one of them.
+        if self.relay is not None:
+            self.relay.terminate()
+
+def serve_relay(port):
+    # A standalone relay, so its memory can be measured on its own.
+    from modules.relay.service import RelayService
+
+    class Ivy:
+        id = 'loadgen-relay'
+
+    class Module:
+        ivy = Ivy()
+        # Never the Unix socket, which belongs to the relay on this machine.
+        config = {'socket': None}
+        logger = logging.getLogger('relay')
+
+    async def main():
+        RelayService(Module(), port).start_service()
+
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulates a fleet of miners and dashboards against a relay on this machine.')
+
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=29203)
+
+    parser.add_argument('--miners', type=int, default=1000)
+    parser.add_argument('--dashboards', type=int, default=5)
+    parser.add_argument('--gpus', type=int, default=6, help='GPUs per simulated miner.')
+    parser.add_argument('--codecs', type=lambda x: x.split(','), default=None, help='Codecs the miners offer, e.g. json or ivy-msgpack,ivy-json.')
+
+    parser.add_argument('--tick', type=float, default=5, help='Seconds between a miner\'s stat checks.')
+    parser.add_argument('--refresh', type=float, default=60, help='Seconds before a miner sends its stats regardless of changes.')
+    parser.add_argument('--change', type=float, default=.05, help='Chance that a miner\'s stats changed on a tick.')
+    parser.add_argument('--actions', type=float, default=1, help='Machine actions sent by dashboards per second.')
+
+    parser.add_argument('--ramp', type=int, default=500, help='Miners connected per second, 0 for all at once.')
+    parser.add_argument('--duration', type=float, default=120, help='Seconds to measure for, once connected.')
+    parser.add_argument('--report', type=float, default=10, help='Seconds between reports.')
+
+    parser.add_argument('--relay-pid', type=int, default=None, help='Relay process to report memory for.')
+    parser.add_argument('--compute-pid', type=int, default=None, help='Compute process to report memory for.')
+    parser.add_argument('--spawn-relay', action='store_true', help='Start a standalone relay (without compute) to test against.')
+    parser.add_argument('--serve-relay', action='store_true', help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+
+    # Every simulated connection is a socket, on both ends.
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    if args.serve_relay:
+        serve_relay(args.port)
+        sys.exit(0)
+
+    if args.miners + args.dashboards > hard - 64:
+        print('Warning: only %d file descriptors are available.' % hard)
+
+    fleet = Fleet(args)
+
+    if args.spawn_relay:
+        fleet.relay = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve-relay', '--port', str(args.port)])
+        args.relay_pid = fleet.relay.pid
+
+        time.sleep(2)
+
+    try:
+        asyncio.run(fleet.run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if fleet.relay is not None:
+            fleet.relay.terminate()
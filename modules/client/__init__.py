@@ -55,7 +55,7 @@ class ClientModule(Module):
         self.logger.exception(traceback.format_exc())
 
     def on_connect_relay(self, service):
-        self.connector.open(service.ip, service.port, {
+        self.open_relay(service, {
             'Miner-ID': self.ivy.id,
             'Subscribe': {
                 'machine': ['action'],
@@ -10,6 +10,7 @@ from datetime import datetime, timedelta
 from wakeonlan import send_magic_packet
 
 from epyphany import Service
+from ivy import metrics
 from ivy.module import Module
 from ivy.model.client import Client
 from ivy.model.config import Config
@@ -26,6 +27,11 @@ from .database import Database
 
 IMMEDIATE_STAT_CUTOFF = 100
 
+# Metrics are served by the relay's HTTP server when it runs in the same
+# process. Otherwise compute serves them on this port. Can be changed with
+# 'metrics' in the compute config, or turned off with null.
+METRICS_PORT = 29205
+
 def new_id():
     return ''.join(random.choice(string.ascii_lowercase + string.ascii_uppercase + string.digits) for i in range(8))
 
@@ -42,6 +48,15 @@ class ComputeModule(Module):
 
         asyncio.ensure_future(self.update())
 
+        port = self.config['metrics'] if 'metrics' in self.config else METRICS_PORT
+
+        if port and not any([hasattr(module, 'IS_RELAY') and module.IS_RELAY for module in self.ivy.modules.values()]):
+            asyncio.ensure_future(metrics.serve(port))
+            asyncio.ensure_future(metrics.monitor_loop_lag())
+
+    async def on_stop(self):
+        await self.database.on_stop()
+
     async def update(self):
         last_refresh = time.time()
 
@@ -50,6 +65,8 @@ class ComputeModule(Module):
                 await asyncio.sleep(60)
 
                 if time.time() - last_refresh > 60 * 60:
+                    last_refresh = time.time()
+
                     await self.connector.socket.send('coins', 'data', self.database.coins)
                     await self.connector.socket.send('tickers', 'data', self.database.tickers)
                     await self.connector.socket.send('software', 'data', self.database.software)
@@ -70,7 +87,7 @@ class ComputeModule(Module):
                 self.logger.exception('\n' + traceback.format_exc())
 
     def on_connect_relay(self, service):
-        self.connector.open(service.ip, service.port, {
+        self.open_relay(service, {
             'Subscribe': {
                 'connection': ['*'],
 
@@ -87,10 +104,21 @@ class ComputeModule(Module):
 
                 'machine': ['*'],
                 'miner': ['*'],
-                'stats': ['query']
+                'stats': ['query', 'gpus']
             }
         })
 
+    async def event_connection_open(self, packet):
+        await super().event_connection_open(packet)
+
+        # Gives the relay something to hand out, so it doesn't need to ask us.
+        if packet.dummy:
+            for thing in ['coins', 'tickers', 'software']:
+                data = getattr(self.database, thing)
+
+                if data:
+                    await packet.send(thing, 'data', data)
+
     def register_events(self, l):
         @l.listen_event('connection', 'open')
         async def event(packet):
@@ -114,8 +142,13 @@ class ComputeModule(Module):
                     if len(self.database.stats) < IMMEDIATE_STAT_CUTOFF:
                         await packet.send('machines', 'stats', {miner_id: stats.as_obj()})
 
-        @l.listen_event('stats', 'query')
+        # Long statistics queries shouldn't hold up stat ingestion.
+        @l.listen_event('stats', 'query', concurrent=True)
         async def event(packet):
+            # Sent through Net.request, the result goes back on its own.
+            if packet.rpc is not None:
+                return await self.database.get_statistics(**packet.payload)
+
             stat_id = packet.payload['id']
             del packet.payload['id']
 
@@ -123,6 +156,19 @@ class ComputeModule(Module):
             
             await packet.reply('stats', 'response', payload={'id': stat_id, 'data': stats})
 
+        # The same, per card of one machine, by bus id.
+        @l.listen_event('stats', 'gpus', concurrent=True)
+        async def event(packet):
+            if packet.rpc is not None:
+                return await self.database.get_gpu_statistics(**packet.payload)
+
+            stat_id = packet.payload['id']
+            del packet.payload['id']
+
+            stats = await self.database.get_gpu_statistics(**packet.payload)
+
+            await packet.reply('stats', 'response', payload={'id': stat_id, 'data': stats})
+
 
         for thing in ['software', 'coins', 'tickers', 'fee']:
             def inner(thing):
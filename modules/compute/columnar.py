@@ -0,0 +1,279 @@
+import os
+import json
+import time
+import shutil
+import asyncio
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .statistics import RETENTION, READERS, parse_time, query_range, rows_written
+
+
+# One append-only file per column in each day's directory. Only what the
+# dashboards chart is kept, not the status of each snapshot.
+COLUMNS = [
+    ('date', '<i8'),
+    ('machine', '<i4'),
+
+    ('watts', '<f8'),
+    ('temp', '<f8'),
+    ('fan', '<f8'),
+    ('rate', '<f8'),
+
+    ('shares_accepted', '<i8'),
+    ('shares_rejected', '<i8'),
+    ('shares_invalid', '<i8')
+]
+
+DAY = 86400
+
+class ColumnarStore:
+    # The same interface as statistics.Store, on memory-mapped NumPy arrays
+    # instead of sqlite. Selected with 'backend': 'columnar' under
+    # 'statistics' in the database config.
+    def __init__(self, logger, config=None):
+        self.logger = logger.getChild('stats')
+
+        self.config = config if config else {}
+
+        self.path = os.path.join('/etc', 'ivy', 'statistics')
+        os.makedirs(self.path, exist_ok=True)
+
+        # Machines are stored by their position in this list
+        self.machines_file = os.path.join(self.path, 'machines.json')
+        self.machines = []
+
+        if os.path.exists(self.machines_file):
+            with open(self.machines_file, 'r') as f:
+                self.machines = json.load(f)
+
+        self.index = {id: i for i, id in enumerate(self.machines)}
+
+        retention = dict(RETENTION)
+        if 'retention' in self.config:
+            retention.update(self.config['retention'])
+
+        # Whole days are dropped, once all of them are past it.
+        self.retention = parse_time(retention['raw']).total_seconds() if retention['raw'] else None
+
+        # Appends happen one after another, off the event loop.
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='statistics-writer')
+        self.readers = ThreadPoolExecutor(max_workers=self.config['readers'] if 'readers' in self.config else READERS, thread_name_prefix='statistics-reader')
+
+        self.last_day = None
+
+        # date: snapshots submitted to the writer but not appended yet
+        self.dates = {}
+        self.lock = threading.Lock()
+
+    def day_path(self, day):
+        return os.path.join(self.path, datetime.fromtimestamp(day * DAY, timezone.utc).strftime('%Y-%m-%d'))
+
+    async def flush(self):
+        await asyncio.get_event_loop().run_in_executor(self.writer, lambda: None)
+
+    async def close(self):
+        await self.flush()
+
+        self.writer.shutdown(wait=False)
+        self.readers.shutdown(wait=False)
+
+    async def save_snapshot(self, snapshots):
+        rows = []
+        for id, stats in snapshots.items():
+            rows.append(
+                        (
+                            id,
+                            int(stats.time),
+
+                            sum([gpu.watts for gpu in stats.hardware.gpus]),
+                            max([gpu.temp for gpu in stats.hardware.gpus]),
+                            max([gpu.fan for gpu in stats.hardware.gpus]),
+                            sum([gpu.rate for gpu in stats.hardware.gpus]),
+
+                            stats.shares['accepted'],
+                            stats.shares['rejected'],
+                            stats.shares['invalid']
+                        )
+                    )
+
+        if len(rows) > 0:
+            with self.lock:
+                for row in rows:
+                    self.dates[row[1]] = self.dates.get(row[1], 0) + 1
+
+            self.writer.submit(self.write, rows)
+
+    def oldest_pending(self):
+        with self.lock:
+            return min(self.dates) if len(self.dates) > 0 else None
+
+    def write(self, rows):
+        try:
+            new = [row[0] for row in rows if row[0] not in self.index]
+
+            if len(new) > 0:
+                for id in new:
+                    if id not in self.index:
+                        self.index[id] = len(self.machines)
+                        self.machines.append(id)
+
+                # Before any rows refer to them
+                with open(self.machines_file + '.tmp', 'w') as f:
+                    json.dump(self.machines, f)
+                os.replace(self.machines_file + '.tmp', self.machines_file)
+
+            columns = [np.array([row[1] for row in rows], dtype=COLUMNS[0][1]), np.array([self.index[row[0]] for row in rows], dtype=COLUMNS[1][1])]
+            columns += [np.array([row[i] for row in rows], dtype=dtype) for i, (name, dtype) in enumerate(COLUMNS[2:], start=2)]
+
+            days = columns[0] // DAY
+
+            for day in np.unique(days):
+                day = int(day)
+                mask = days == day
+
+                path = self.day_path(day)
+                os.makedirs(path, exist_ok=True)
+
+                for (name, dtype), column in zip(COLUMNS, columns):
+                    with open(os.path.join(path, name), 'ab') as f:
+                        f.write(column[mask].tobytes())
+
+                if self.last_day is None or day > self.last_day:
+                    self.last_day = day
+                    self.expire()
+
+            rows_written.inc(len(rows))
+        except Exception:
+            self.logger.exception('\n' + traceback.format_exc())
+        finally:
+            with self.lock:
+                for row in rows:
+                    if self.dates[row[1]] > 1:
+                        self.dates[row[1]] -= 1
+                    else:
+                        del self.dates[row[1]]
+
+    def expire(self):
+        if self.retention is None:
+            return
+
+        cutoff = self.day_path(int((time.time() - self.retention) // DAY))
+
+        # Directory names sort by date.
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+
+            if os.path.isdir(path) and name < os.path.basename(cutoff):
+                shutil.rmtree(path, ignore_errors=True)
+
+    def read_day(self, day):
+        # The columns of one day, as far as all of them have been written.
+        path = self.day_path(day)
+
+        if not os.path.isdir(path):
+            return None
+
+        sizes = []
+        for name, dtype in COLUMNS:
+            file = os.path.join(path, name)
+            sizes.append(os.path.getsize(file) // np.dtype(dtype).itemsize if os.path.exists(file) else 0)
+
+        length = min(sizes)
+        if length == 0:
+            return None
+
+        return [np.memmap(os.path.join(path, name), dtype=dtype, mode='r', shape=(length,)) for name, dtype in COLUMNS]
+
+    async def get_statistics(self, start=None, end=None, increment='5m', machine_id=None):
+        return await asyncio.get_event_loop().run_in_executor(self.readers, self.read_statistics, start, end, increment, machine_id)
+
+    async def get_gpu_statistics(self, machine_id, start=None, end=None, increment='5m'):
+        # Per card history is only kept by the sqlite Store.
+        return {}
+
+    def read_statistics(self, start=None, end=None, increment='5m', machine_id=None):
+        start, end, increment = query_range(start, end, increment)
+
+        results = []
+
+        if end < start:
+            return results
+
+        # Bucket k covers [start + k * increment, start + (k + 1) * increment),
+        # and the first has never been part of the results, as with sqlite.
+        parts = []
+
+        for day in range(int(start // DAY), int((end + increment) // DAY) + 1):
+            columns = self.read_day(day)
+            if columns is None:
+                continue
+
+            mask = (columns[0] >= start) & (columns[0] <= end + increment)
+
+            if machine_id is not None:
+                mask &= columns[1] == (self.index[machine_id] if machine_id in self.index else -1)
+
+            parts.append([column[mask] for column in columns])
+
+        packs = {}
+
+        if len(parts) > 0:
+            date, machine, watts, temp, fan, rate, accepted, rejected, invalid = [np.concatenate(column) for column in zip(*parts)]
+
+            k = np.floor((date - start) / increment).astype(np.int64)
+
+            keep = k > 0
+            if not keep.all():
+                k, machine, watts, temp, fan, rate, accepted, rejected, invalid = [column[keep] for column in (k, machine, watts, temp, fan, rate, accepted, rejected, invalid)]
+
+        if len(parts) > 0 and len(k) > 0:
+            # Every machine in the rows read is in the index by now.
+            machines = len(self.machines)
+
+            # Each machine's average per bucket...
+            groups, inverse = np.unique(k * machines + machine, return_inverse=True)
+            snapshots = np.bincount(inverse)
+
+            watts, temp, fan, rate = [np.bincount(inverse, weights=column) / snapshots for column in (watts, temp, fan, rate)]
+            accepted, rejected, invalid = [np.bincount(inverse, weights=column) for column in (accepted, rejected, invalid)]
+
+            # ...then folded across machines.
+            buckets, first = np.unique(groups // machines, return_index=True)
+
+            watts, rate, accepted, rejected, invalid = [np.add.reduceat(column, first) for column in (watts, rate, accepted, rejected, invalid)]
+            temp, fan = [np.maximum(np.maximum.reduceat(column, first), 0) for column in (temp, fan)]
+
+            for i, bucket in enumerate(buckets.tolist()):
+                packs[bucket] = {
+                    'watts': float(watts[i]),
+                    'temp': float(temp[i]),
+                    'fan': float(fan[i]),
+                    'rate': float(rate[i]),
+
+                    'shares': {
+                        'accepted': int(accepted[i]),
+                        'rejected': int(rejected[i]),
+                        'invalid': int(invalid[i])
+                    }
+                }
+
+        last = max(packs) if packs else 0
+
+        label = start
+        bucket = 0
+
+        while bucket < last or label + increment <= end:
+            label += increment
+            bucket += 1
+
+            results.append([label, packs[bucket] if bucket in packs else None])
+
+        return results
@@ -6,7 +6,8 @@ import traceback
 import urllib.request
 
 from ivy.model.fee import Fee
-from .statistics import Store
+from .statistics import Store, QueryCache, CACHE_BYTES
+from . import columnar
 
 
 def url_content(url):
@@ -29,7 +30,10 @@ class Database(dict):
         if 'last_check' not in self.config:
             self.config['last_check'] = 0
 
-        self.statistics = Store(self.logger)
+        statistics = self.config['statistics'] if 'statistics' in self.config else {}
+
+        self.statistics = self.open_statistics(statistics)
+        self.statistics_cache = QueryCache(self.statistics, statistics['cache'] if 'cache' in statistics else CACHE_BYTES)
 
         self.strategy = None
         asyncio.ensure_future(self.apply_strategy(config['type']))
@@ -186,11 +190,27 @@ class Database(dict):
 
             await asyncio.sleep(60 * 60)
 
+    def open_statistics(self, config):
+        if 'backend' in config and config['backend'] == 'columnar':
+            if columnar.np is not None:
+                return columnar.ColumnarStore(self.logger, config)
+
+            self.logger.warning('The columnar statistics backend needs numpy. Using sqlite instead.')
+
+        return Store(self.logger, config)
+
     async def save_snapshot(self, snapshot):
         try:
             await self.statistics.save_snapshot(snapshot)
         except Exception as e:
             self.logger.exception('\n' + traceback.format_exc())
     
+    async def on_stop(self):
+        # Commits whatever snapshots are still waiting.
+        await self.statistics.close()
+
     async def get_statistics(self, *args, **kwargs):
-        return await self.statistics.get_statistics(*args, **kwargs)
+        return await self.statistics_cache.get_statistics(*args, **kwargs)
+
+    async def get_gpu_statistics(self, *args, **kwargs):
+        return await self.statistics.get_gpu_statistics(*args, **kwargs)
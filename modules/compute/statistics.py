@@ -1,9 +1,74 @@
 import os
+import sys
 import json
 import re
+import time
+import struct
+import queue
+import asyncio
+import threading
+import traceback
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, date, timedelta, timezone
 import sqlite3
 
+from ivy import metrics
+
+
+# Snapshots are committed in groups, once this many rows are waiting or the
+# oldest of them has waited this many seconds. Can be changed with 'batch'
+# and 'interval' under 'statistics' in the database config.
+WRITER_BATCH = 5000
+WRITER_INTERVAL = 1
+
+# Statistics queries run at most this many at a time, each on its own
+# read-only connection. Can be changed with 'readers'.
+READERS = 2
+
+# Per machine sums of the snapshots in each period, kept up to date as
+# snapshots are written. Coarsest first, named after parse_time increments.
+ROLLUPS = [('1d', 86400), ('1hr', 3600), ('5m', 300), ('1m', 60)]
+
+# PRAGMA user_version of statistics.sql:
+#   0  only the original `statistics` table
+#   1  snapshots are written to `statistics_v2`, older ones are being moved over
+#   2  only `statistics_v2`
+SCHEMA_VERSION = 2
+
+# Rows moved from `statistics` to `statistics_v2` per transaction, whenever
+# the writer has nothing else to do.
+MIGRATION_CHUNK = 5000
+
+# Each machine snapshot's cards, packed into one blob: watts, temp, fan and
+# rate of every card in the order of its layout, the list of bus ids.
+GPU_FORMAT = struct.Struct('<4f')
+
+# How long raw snapshots and each rollup are kept, None for forever. Older
+# ranges are still answered from the rollups that remain. Can be changed
+# with 'retention' under 'statistics', e.g. {'raw': '7d', '1hr': '1yr'}.
+RETENTION = {'raw': '30d', 'gpus': '30d', '1m': '30d', '5m': '6mth', '1hr': '2yr', '1d': None}
+# Expired rows are looked for this often, and deleted this many per
+# transaction whenever the writer has nothing else to do.
+RETENTION_INTERVAL = 3600
+RETENTION_CHUNK = 5000
+# Free pages handed back to the filesystem per step afterwards.
+VACUUM_PAGES = 1000
+
+# Closed buckets of past queries are kept for the next poll, up to roughly
+# this many bytes. Can be changed with 'cache', 0 turns it off.
+CACHE_BYTES = 16 * 1024 * 1024
+# Seconds after its end before a bucket is considered closed, so snapshots
+# not yet handed to the store aren't left out of it for good. Buckets of
+# snapshots that are waiting to be written are never closed.
+CACHE_GRACE = 60
+
+commit_seconds = metrics.histogram('ivy_statistics_commit_seconds', 'Time taken to write and commit a group of snapshots.')
+rows_written = metrics.counter('ivy_statistics_rows_written_total', 'Snapshot rows committed to the statistics database.')
+rows_expired = metrics.counter('ivy_statistics_rows_expired_total', 'Rows deleted from the statistics database once past their retention.', ['table'])
+cache_hits = metrics.counter('ivy_statistics_cache_hits_total', 'Statistics buckets answered from the query cache.')
+cache_misses = metrics.counter('ivy_statistics_cache_misses_total', 'Statistics buckets read from the store.')
+
 
 regex = re.compile(r'^(?:(?P<years>\d+?)yr)?(?:(?P<months>\d+?)mth)?(?:(?P<days>\d+?)d)?(?:(?P<hours>\d+?)hr)?(?:(?P<minutes>\d+?)m)?(?:(?P<seconds>\d+?)s)?$')
 def parse_time(time_str):
@@ -18,8 +83,25 @@ def parse_time(time_str):
     if 'months' in time_params:
         time_params['days'] = time_params['months'] * 30 + (time_params['days'] if 'days' in time_params else 0)
         del time_params['months']
+    if 'years' in time_params:
+        time_params['days'] = time_params['years'] * 365 + (time_params['days'] if 'days' in time_params else 0)
+        del time_params['years']
     return timedelta(**time_params)
 
+def query_range(start=None, end=None, increment='5m'):
+    # The range and increment, in seconds, that a statistics query covers.
+    if end is None:
+        end = datetime.utcnow().replace(tzinfo=timezone.utc).timestamp()
+
+    increment = parse_time(increment).total_seconds()
+
+    end = end - end % increment
+
+    if start is None:
+        start = end - increment * 24
+
+    return start, end, increment
+
 def new_pack():
     return {
         'watts': 0,
@@ -59,43 +141,425 @@ def compile_stats(interval_stats):
 
     return stats
 
-class Store:
-    def __init__(self, logger):
-        self.logger = logger.getChild('stats')
+class StatsWriter(threading.Thread):
+    # Writes snapshots on its own connection and thread, so neither the
+    # inserts nor the fsyncs of a commit hold up the event loop.
+    def __init__(self, path, logger, batch=WRITER_BATCH, interval=WRITER_INTERVAL, retention=None, migrating=False):
+        super().__init__(name='statistics-writer', daemon=True)
 
-        self.sql = sqlite3.connect(os.path.join('/etc', 'ivy', 'statistics.sql'))
-        self.query = self.sql.cursor()
+        self.path = path
+        self.logger = logger
 
-        self.logger.info('Creating table if it does not exist...')
-        self.query.execute('''
-CREATE TABLE IF NOT EXISTS `statistics` (
+        self.batch = batch
+        self.interval = interval
+
+        # {'raw' or rollup name: seconds to keep, or None}
+        self.retention = retention if retention else {}
+
+        # Expired rows are being deleted, or the file shrunk
+        self.expiring = False
+        self.next_expiry = time.monotonic()
+
+        # ([row, row], [gpu row, gpu row]), a Future to resolve once
+        # everything before it is committed, or None to stop
+        self.queue = queue.Queue()
+
+        # json list of bus ids: id in `statistics_gpu_layouts`
+        self.layouts = None
+
+        # Rows waiting to be committed, and how many of them there are per date
+        self.pending = 0
+        self.dates = {}
+        self.lock = threading.Lock()
+
+        # Set once the rollup tables can be read from
+        self.rollups_ready = threading.Event()
+
+        # Set once every snapshot is in `statistics_v2`
+        self.migrated = threading.Event()
+        if not migrating: self.migrated.set()
+
+    def put(self, rows, gpus):
+        with self.lock:
+            self.pending += len(rows)
+
+            for row in rows:
+                self.dates[row[1]] = self.dates.get(row[1], 0) + 1
+
+        self.queue.put((rows, gpus))
+
+    def oldest_pending(self):
+        # Date of the oldest snapshot not committed yet, or None.
+        with self.lock:
+            return min(self.dates) if len(self.dates) > 0 else None
+
+    def flush(self):
+        future = Future()
+        self.queue.put(future)
+        return future
+
+    def stop(self):
+        future = self.flush()
+        self.queue.put(None)
+        return future
+
+    def run(self):
+        sql = sqlite3.connect(self.path)
+        sql.execute('PRAGMA journal_mode=WAL')
+        # Durable as of the last checkpoint if power is lost, which is fine for stats.
+        sql.execute('PRAGMA synchronous=NORMAL')
+
+        self.create_rollups(sql)
+        self.rollups_ready.set()
+
+        rows = []
+        gpus = []
+        deadline = None
+
+        waiters = []
+        stop = False
+
+        while not stop:
+            if len(rows) > 0:
+                timeout = max(0, deadline - time.monotonic())
+            elif not self.migrated.is_set() or self.expiring:
+                timeout = 0
+            else:
+                timeout = max(0, self.next_expiry - time.monotonic())
+
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = ([], [])
+
+                if len(rows) == 0:
+                    if not self.migrated.is_set():
+                        self.migrate(sql)
+                    elif self.expiring or time.monotonic() >= self.next_expiry:
+                        self.expiring = self.expire(sql)
+
+                        if not self.expiring:
+                            self.next_expiry = time.monotonic() + RETENTION_INTERVAL
+
+            if item is None:
+                stop = True
+            elif isinstance(item, Future):
+                waiters.append(item)
+            elif len(item[0]) > 0:
+                if len(rows) == 0:
+                    deadline = time.monotonic() + self.interval
+                rows.extend(item[0])
+                gpus.extend(item[1])
+
+            if len(rows) > 0 and (len(rows) >= self.batch or time.monotonic() >= deadline or len(waiters) > 0 or stop):
+                self.commit(sql, rows, gpus)
+                rows = []
+                gpus = []
+
+            for waiter in waiters:
+                waiter.set_result(None)
+            waiters.clear()
+
+        sql.close()
+
+    def migrate(self, sql):
+        # Moves the oldest chunk of `statistics` over, in one transaction so
+        # readers never see a snapshot twice, or not at all.
+        try:
+            last = sql.execute('SELECT `rowid` FROM `statistics` ORDER BY `rowid` LIMIT 1 OFFSET ?', (MIGRATION_CHUNK - 1,)).fetchone()
+            last = last[0] if last is not None else sql.execute('SELECT MAX(`rowid`) FROM `statistics`').fetchone()[0]
+
+            if last is not None:
+                sql.execute('BEGIN')
+                sql.execute('''INSERT OR IGNORE INTO `statistics_v2` SELECT `machine_id`, CAST(`date` AS INTEGER), `connected`, `status`, `is_fee`,
+                                `watts`, `temp`, `fan`, `rate`, `shares_accepted`, `shares_rejected`, `shares_invalid` FROM `statistics` WHERE `rowid` <= ?''', (last,))
+                sql.execute('DELETE FROM `statistics` WHERE `rowid` <= ?', (last,))
+                sql.commit()
+                return
+
+            # The table itself is dropped by the next Store, before anything can read from it.
+            sql.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+            sql.commit()
+
+            self.logger.info('Finished moving snapshots to statistics_v2.')
+
+            self.migrated.set()
+        except Exception:
+            self.logger.exception('\n' + traceback.format_exc())
+
+            sql.rollback()
+
+            # Not worth spinning on. Try again on the next start.
+            self.migrated.set()
+
+    def expired(self, name, date):
+        return name in self.retention and self.retention[name] is not None and date < time.time() - self.retention[name]
+
+    def expire(self, sql):
+        # One small step: a chunk of expired rows from one table, or some free
+        # pages given back. Returns whether there's more to do.
+        try:
+            tables = [('raw', 'statistics_v2', '`machine_id`, `date`', '`date`'), ('gpus', 'statistics_gpus', '`machine_id`, `date`', '`date`')]
+            tables += [(name, 'statistics_%s' % name, '`bucket`, `machine_id`', '`bucket`') for name, seconds in ROLLUPS]
+
+            for name, table, key, column in tables:
+                if name not in self.retention or self.retention[name] is None:
+                    continue
+
+                cursor = sql.execute('DELETE FROM `%s` WHERE (%s) IN (SELECT %s FROM `%s` WHERE %s < ? LIMIT ?)' % (table, key, key, table, column),
+                                        (int(time.time() - self.retention[name]), RETENTION_CHUNK))
+                sql.commit()
+
+                if cursor.rowcount > 0:
+                    rows_expired.inc(cursor.rowcount, table=table)
+                    return True
+
+            # Only once the database was created with auto_vacuum = INCREMENTAL.
+            # Otherwise sqlite reuses the free pages for new snapshots instead.
+            if sql.execute('PRAGMA freelist_count').fetchone()[0] > 0 and sql.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+                sql.execute('PRAGMA incremental_vacuum(%d)' % VACUUM_PAGES).fetchall()
+                sql.commit()
+                return True
+        except Exception:
+            self.logger.exception('\n' + traceback.format_exc())
+
+            sql.rollback()
+
+        return False
+
+    def source(self):
+        # Raw snapshots, wherever they are right now
+        if self.migrated.is_set():
+            return '`statistics_v2`'
+        return '(SELECT * FROM `statistics` UNION ALL SELECT * FROM `statistics_v2`)'
+
+    def create_rollups(self, sql):
+        existing = [row[0] for row in sql.execute("SELECT `name` FROM `sqlite_master` WHERE `type` = 'table'")]
+
+        for name, seconds in ROLLUPS:
+            table = 'statistics_%s' % name
+
+            if table in existing:
+                continue
+
+            self.logger.info('Creating %s and filling it from existing snapshots...' % table)
+
+            # In one transaction, so an interrupted fill starts over next time.
+            sql.execute('BEGIN')
+
+            sql.execute('''
+CREATE TABLE `%s` (
+  `bucket` DATETIME NOT NULL,
   `machine_id` VARCHAR(64) NOT NULL,
-  `date` DATETIME NOT NULL,
 
-  `connected` BOOLEAN NOT NULL,
-  `status` INT(11) NOT NULL,
-  `is_fee` BOOLEAN NOT NULL,
+  `snapshots` INT(11) NOT NULL,
 
-  `watts` INT(11) NOT NULL,
-  `temp` INT(11) NOT NULL,
-  `fan` INT(11) NOT NULL,
-  `rate` INT(11) NOT NULL,
+  `watts` REAL NOT NULL,
+  `temp` REAL NOT NULL,
+  `fan` REAL NOT NULL,
+  `rate` REAL NOT NULL,
 
   `shares_accepted` INT(11) NOT NULL,
   `shares_rejected` INT(11) NOT NULL,
   `shares_invalid` INT(11) NOT NULL,
+  PRIMARY KEY (`bucket`, `machine_id`)
+)''' % table)
+
+            sql.execute('''INSERT INTO `%s` SELECT CAST(`date` / %d AS INTEGER) * %d AS `b`, `machine_id`, COUNT(*),
+                            SUM(`watts`), SUM(`temp`), SUM(`fan`), SUM(`rate`), SUM(`shares_accepted`), SUM(`shares_rejected`), SUM(`shares_invalid`)
+                            FROM %s GROUP BY `b`, `machine_id`''' % (table, seconds, seconds, self.source()))
+
+            sql.commit()
+
+    def rollup(self, sql, rows):
+        # Only rows that were actually inserted, so each adds to its periods once.
+        for name, seconds in ROLLUPS:
+            buckets = {}
+
+            for row in rows:
+                key = (int(row[1] // seconds) * seconds, row[0])
+
+                if key not in buckets:
+                    buckets[key] = [0, 0, 0, 0, 0, 0, 0, 0]
+
+                values = buckets[key]
+
+                values[0] += 1
+
+                for i in range(1, 8):
+                    values[i] += row[4 + i]
+
+            sql.executemany('''INSERT INTO `statistics_%s` VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                                ON CONFLICT(`bucket`, `machine_id`) DO UPDATE SET `snapshots` = `snapshots` + excluded.`snapshots`,
+                                    `watts` = `watts` + excluded.`watts`, `temp` = `temp` + excluded.`temp`, `fan` = `fan` + excluded.`fan`, `rate` = `rate` + excluded.`rate`,
+                                    `shares_accepted` = `shares_accepted` + excluded.`shares_accepted`,
+                                    `shares_rejected` = `shares_rejected` + excluded.`shares_rejected`,
+                                    `shares_invalid` = `shares_invalid` + excluded.`shares_invalid`''' % name,
+                            [key + tuple(values) for key, values in buckets.items()])
+
+    def layout(self, sql, bus_ids):
+        if self.layouts is None:
+            self.layouts = {row[1]: row[0] for row in sql.execute('SELECT `id`, `bus_ids` FROM `statistics_gpu_layouts`')}
+
+        if bus_ids not in self.layouts:
+            self.layouts[bus_ids] = sql.execute('INSERT INTO `statistics_gpu_layouts` (`bus_ids`) VALUES(?)', (bus_ids,)).lastrowid
+
+        return self.layouts[bus_ids]
+
+    def commit(self, sql, rows, gpus):
+        start = time.perf_counter()
+
+        try:
+            # Two snapshots of a machine within the same second share a date.
+            # The first one is kept, the same as in migrate().
+            inserted = [row for row in rows if sql.execute('''INSERT OR IGNORE INTO `statistics_v2` VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', row).rowcount > 0]
+
+            self.rollup(sql, inserted)
+            sql.executemany('''INSERT OR IGNORE INTO `statistics_gpus` VALUES(?, ?, ?, ?)''',
+                                [(machine_id, date, self.layout(sql, bus_ids), data) for machine_id, date, bus_ids, data in gpus])
+            sql.commit()
+
+            rows_written.inc(len(rows))
+        except Exception:
+            self.logger.exception('\n' + traceback.format_exc())
+
+            sql.rollback()
+
+            # New layouts may have been rolled back with the rest.
+            self.layouts = None
+
+        commit_seconds.observe(time.perf_counter() - start)
+
+        with self.lock:
+            self.pending -= len(rows)
+
+            for row in rows:
+                if self.dates[row[1]] > 1:
+                    self.dates[row[1]] -= 1
+                else:
+                    del self.dates[row[1]]
+
+class Store:
+    def __init__(self, logger, config=None):
+        self.logger = logger.getChild('stats')
+
+        self.config = config if config else {}
+
+        self.path = os.path.join('/etc', 'ivy', 'statistics.sql')
+
+        self.sql = sqlite3.connect(self.path)
+        self.query = self.sql.cursor()
+
+        # Lets the file shrink as old snapshots expire. Only takes effect on a
+        # new database; an existing one just reuses the space it frees.
+        self.query.execute('PRAGMA auto_vacuum = INCREMENTAL')
+
+        # Lets the writer commit while statistics are being read.
+        self.query.execute('PRAGMA journal_mode=WAL')
+
+        version = self.query.execute('PRAGMA user_version').fetchone()[0]
+        tables = [row[0] for row in self.query.execute("SELECT `name` FROM `sqlite_master` WHERE `type` = 'table'")]
+
+        self.logger.info('Creating table if it does not exist...')
+        # Clustered by machine for single machine queries, with `date` indexed
+        # for the whole fleet. Dates are whole seconds.
+        self.query.execute('''
+CREATE TABLE IF NOT EXISTS `statistics_v2` (
+  `machine_id` TEXT NOT NULL,
+  `date` INTEGER NOT NULL,
+
+  `connected` INTEGER NOT NULL,
+  `status` TEXT NOT NULL,
+  `is_fee` INTEGER NOT NULL,
+
+  `watts` REAL NOT NULL,
+  `temp` REAL NOT NULL,
+  `fan` REAL NOT NULL,
+  `rate` REAL NOT NULL,
+
+  `shares_accepted` INTEGER NOT NULL,
+  `shares_rejected` INTEGER NOT NULL,
+  `shares_invalid` INTEGER NOT NULL,
   PRIMARY KEY (`machine_id`, `date`)
+) WITHOUT ROWID''')
+        self.query.execute('CREATE INDEX IF NOT EXISTS `statistics_v2_date` ON `statistics_v2` (`date`)')
+
+        # One row per machine snapshot, however many cards it has.
+        self.query.execute('''
+CREATE TABLE IF NOT EXISTS `statistics_gpus` (
+  `machine_id` TEXT NOT NULL,
+  `date` INTEGER NOT NULL,
+
+  `layout` INTEGER NOT NULL,
+  `gpus` BLOB NOT NULL,
+  PRIMARY KEY (`machine_id`, `date`)
+) WITHOUT ROWID''')
+        self.query.execute('CREATE INDEX IF NOT EXISTS `statistics_gpus_date` ON `statistics_gpus` (`date`)')
+
+        self.query.execute('''
+CREATE TABLE IF NOT EXISTS `statistics_gpu_layouts` (
+  `id` INTEGER PRIMARY KEY,
+  `bus_ids` TEXT NOT NULL UNIQUE
 )''')
 
+        if 'statistics' not in tables:
+            version = SCHEMA_VERSION
+        elif version == SCHEMA_VERSION:
+            self.query.execute('DROP TABLE `statistics`')
+        else:
+            # The writer moves existing snapshots over in the background.
+            self.logger.info('Moving snapshots to statistics_v2...')
+            version = 1
+
+        self.query.execute('PRAGMA user_version = %d' % version)
+
         self.sql.commit()
 
+        retention = dict(RETENTION)
+        if 'retention' in self.config:
+            retention.update(self.config['retention'])
+
+        for name, keep in retention.items():
+            retention[name] = parse_time(keep).total_seconds() if keep else None
+
+        self.writer = StatsWriter(self.path, self.logger,
+                                    batch=self.config['batch'] if 'batch' in self.config else WRITER_BATCH,
+                                    interval=self.config['interval'] if 'interval' in self.config else WRITER_INTERVAL,
+                                    retention=retention,
+                                    migrating=version < SCHEMA_VERSION)
+        self.writer.start()
+
+        self.readers = ThreadPoolExecutor(max_workers=self.config['readers'] if 'readers' in self.config else READERS, thread_name_prefix='statistics-reader')
+
+        # One connection per reader thread
+        self.local = threading.local()
+
+        metrics.gauge('ivy_statistics_queue_rows', 'Snapshot rows waiting to be committed.', collect=lambda: {(): self.writer.pending})
+
+    async def flush(self):
+        await asyncio.wrap_future(self.writer.flush())
+
+    def oldest_pending(self):
+        return self.writer.oldest_pending()
+
+    async def close(self):
+        await asyncio.wrap_future(self.writer.stop())
+
+        self.readers.shutdown(wait=False)
+
+    def reader(self):
+        if not hasattr(self.local, 'sql'):
+            self.local.sql = sqlite3.connect('file:%s?mode=ro' % self.path, uri=True)
+        return self.local.sql
+
     async def save_snapshot(self, snapshots):
         rows = []
+        gpus = []
         for id, stats in snapshots.items():
             rows.append(
                         (
                             id,
-                            stats.time,
+                            int(stats.time),
 
                             stats.connected,
                             stats.status['type'],
@@ -112,65 +576,110 @@ CREATE TABLE IF NOT EXISTS `statistics` (
                         )
                     )
 
-        self.query.executemany('''REPLACE INTO `statistics` VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', rows)
+            if len(stats.hardware.gpus) > 0:
+                # Cards that don't know their bus id are told apart by position.
+                bus_ids = [gpu.bus_id if gpu.bus_id is not None else '#%d' % i for i, gpu in enumerate(stats.hardware.gpus)]
 
-        self.sql.commit()
+                gpus.append((id, int(stats.time), json.dumps(bus_ids),
+                                b''.join([GPU_FORMAT.pack(gpu.watts, gpu.temp, gpu.fan, gpu.rate) for gpu in stats.hardware.gpus])))
 
-    async def get_statistics(self, start=None, end=None, increment='5m', machine_id=None):
-        if end is None:
-            end = datetime.utcnow().replace(tzinfo=timezone.utc).timestamp()
+        self.writer.put(rows, gpus)
 
-        increment = parse_time(increment).total_seconds()
+    def rollup_for(self, start, increment):
+        # The coarsest rollup whose periods line up with the requested
+        # buckets, which start at `start` rather than on a round time.
+        if not self.writer.rollups_ready.is_set():
+            return None
 
-        end = end - end % increment
+        for name, seconds in ROLLUPS:
+            if increment % seconds == 0 and start % seconds == 0 and not self.writer.expired(name, start):
+                return name, seconds
 
-        if start is None:
-            start = end - increment * 24
+        # Raw snapshots this old are gone. The finest rollup left is as close
+        # as it gets, even though its periods straddle the buckets.
+        if self.writer.expired('raw', start):
+            for name, seconds in reversed(ROLLUPS):
+                if increment % seconds == 0 and not self.writer.expired(name, start):
+                    return name, seconds
+
+        return None
+
+    async def get_statistics(self, start=None, end=None, increment='5m', machine_id=None):
+        # Queries can take a while over long ranges. Only the result is awaited here.
+        return await asyncio.get_event_loop().run_in_executor(self.readers, self.read_statistics, start, end, increment, machine_id)
+
+    def read_statistics(self, start=None, end=None, increment='5m', machine_id=None):
+        query = self.reader().cursor()
+
+        start, end, increment = query_range(start, end, increment)
 
         results = []
 
         if end < start:
             return results
 
-        interval_pack = [start, None]
+        # Each machine's snapshots are summed per increment by sqlite. Only the
+        # fold across machines happens here. Bucket k covers
+        # [start + k * increment, start + (k + 1) * increment).
+        rollup = self.rollup_for(start, increment)
+
+        if rollup is None:
+            columns = 'CAST((`date` - ?) / ? AS INTEGER) AS `k`, `machine_id`, COUNT(*), SUM(`watts`), SUM(`temp`), SUM(`fan`), SUM(`rate`), ' \
+                        'SUM(`shares_accepted`), SUM(`shares_rejected`), SUM(`shares_invalid`)'
+
+            table, where = self.writer.source(), '`date` BETWEEN ? and ?'
+        else:
+            columns = 'CAST((`bucket` - ?) / ? AS INTEGER) AS `k`, `machine_id`, SUM(`snapshots`), SUM(`watts`), SUM(`temp`), SUM(`fan`), SUM(`rate`), ' \
+                        'SUM(`shares_accepted`), SUM(`shares_rejected`), SUM(`shares_invalid`)'
+
+            # Periods starting at `end + increment` would only hold what's past it.
+            table, where = '`statistics_%s`' % rollup[0], '`bucket` >= ? AND `bucket` < ?'
 
-        row = None
         if machine_id is None:
-            rows = self.query.execute('SELECT * FROM `statistics` WHERE `date` BETWEEN ? and ?', (start, end + increment))
+            rows = query.execute('SELECT %s FROM %s WHERE %s GROUP BY `k`, `machine_id` ORDER BY `k`' % (columns, table, where),
+                                    (start, increment, start, end + increment))
         else:
-            rows = self.query.execute('SELECT * FROM `statistics` WHERE `machine_id` = ? AND `date` BETWEEN ? and ?', (machine_id, start, end + increment))
+            rows = query.execute('SELECT %s FROM %s WHERE `machine_id` = ? AND %s GROUP BY `k` ORDER BY `k`' % (columns, table, where),
+                                    (start, increment, machine_id, start, end + increment))
+
+        # The first increment, starting at `start` itself, has never been part of the results.
+        interval_pack = [start, None]
+        bucket = 0
 
         interval_stats = None
 
         for row in rows:
-            while row[1] - interval_pack[0] >= increment:
+            if row[0] == 0:
+                continue
+
+            if row[0] != bucket:
                 if interval_stats is not None:
                     interval_pack[1] = compile_stats(interval_stats)
 
                     interval_stats = None
 
-                interval_pack = [interval_pack[0] + increment, None]
-                results.append(interval_pack)
+                while bucket < row[0]:
+                    interval_pack = [interval_pack[0] + increment, None]
+                    results.append(interval_pack)
+
+                    bucket += 1
 
             if interval_stats is None:
                 interval_stats = {}
-            
-            if row[0] not in interval_stats:
-                interval_stats[row[0]] = new_pack()
-                interval_stats[row[0]]['snapshots'] = 0
-            
-            machine_stats = interval_stats[row[0]]
-            
-            machine_stats['snapshots'] += 1
-
-            machine_stats['watts'] += row[5]
-            machine_stats['temp'] += row[6]
-            machine_stats['fan'] += row[7]
-            machine_stats['rate'] += row[8]
-
-            machine_stats['shares']['accepted'] += row[9]
-            machine_stats['shares']['rejected'] += row[10]
-            machine_stats['shares']['invalid'] += row[11]
+
+            machine_stats = new_pack()
+            interval_stats[row[1]] = machine_stats
+
+            machine_stats['snapshots'] = row[2]
+
+            machine_stats['watts'] = row[3]
+            machine_stats['temp'] = row[4]
+            machine_stats['fan'] = row[5]
+            machine_stats['rate'] = row[6]
+
+            machine_stats['shares']['accepted'] = row[7]
+            machine_stats['shares']['rejected'] = row[8]
+            machine_stats['shares']['invalid'] = row[9]
 
         if interval_stats is not None:
             interval_pack[1] = compile_stats(interval_stats)
@@ -183,3 +692,158 @@ CREATE TABLE IF NOT EXISTS `statistics` (
             results.append(interval_pack)
 
         return results
+
+    async def get_gpu_statistics(self, machine_id, start=None, end=None, increment='5m'):
+        return await asyncio.get_event_loop().run_in_executor(self.readers, self.read_gpu_statistics, machine_id, start, end, increment)
+
+    def read_gpu_statistics(self, machine_id, start=None, end=None, increment='5m'):
+        # {bus id: [[time, averages or None], ...]} for each card of one
+        # machine, in the same buckets as read_statistics.
+        query = self.reader().cursor()
+
+        start, end, increment = query_range(start, end, increment)
+
+        if end < start:
+            return {}
+
+        # json list of bus ids: the list, parsed once each
+        layouts = {}
+
+        # bus id: {bucket: [snapshots, watts, temp, fan, rate]}
+        sums = {}
+        last = 0
+
+        # Joined in one statement, so a layout committed along with the
+        # snapshots is always seen with them.
+        for date, layout, data in query.execute('''SELECT `date`, `bus_ids`, `gpus` FROM `statistics_gpus`
+                                                    JOIN `statistics_gpu_layouts` ON `statistics_gpu_layouts`.`id` = `statistics_gpus`.`layout`
+                                                    WHERE `machine_id` = ? AND `date` BETWEEN ? AND ?''',
+                                                (machine_id, start, end + increment)):
+            if layout not in layouts:
+                layouts[layout] = json.loads(layout)
+
+            bucket = int((date - start) / increment)
+
+            if bucket == 0:
+                continue
+
+            last = max(last, bucket)
+
+            for bus_id, values in zip(layouts[layout], GPU_FORMAT.iter_unpack(data)):
+                buckets = sums.setdefault(bus_id, {})
+
+                if bucket not in buckets:
+                    buckets[bucket] = [0, 0, 0, 0, 0]
+
+                total = buckets[bucket]
+                total[0] += 1
+
+                for i in range(4):
+                    total[1 + i] += values[i]
+
+        results = {}
+
+        for bus_id, buckets in sums.items():
+            series = []
+            label = start
+            bucket = 0
+
+            while bucket < last or label + increment <= end:
+                label += increment
+                bucket += 1
+
+                if bucket in buckets:
+                    total = buckets[bucket]
+                    series.append([label, {'watts': total[1] / total[0], 'temp': total[2] / total[0], 'fan': total[3] / total[0], 'rate': total[4] / total[0]}])
+                else:
+                    series.append([label, None])
+
+            results[bus_id] = series
+
+        return results
+
+def size_of(value):
+    # Roughly what a cached key or bucket takes up.
+    size = sys.getsizeof(value)
+
+    if isinstance(value, dict):
+        size += sum([size_of(key) + size_of(item) for key, item in value.items()])
+    elif isinstance(value, (tuple, list)):
+        size += sum([size_of(item) for item in value])
+
+    return size
+
+class QueryCache:
+    # Keeps the buckets of past results by (increment, machine, label). Only
+    # closed buckets are kept, so a repeated query only reads the ones after
+    # them from the store. Cached buckets are shared, and never modified.
+    def __init__(self, store, limit=CACHE_BYTES):
+        self.store = store
+        self.limit = limit
+
+        # key: (bucket, size), least recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+
+        metrics.gauge('ivy_statistics_cache_bytes', 'Approximate size of the statistics query cache.', collect=lambda: {(): self.size})
+
+    async def get_statistics(self, start=None, end=None, increment='5m', machine_id=None):
+        if self.limit <= 0:
+            return await self.store.get_statistics(start=start, end=end, increment=increment, machine_id=machine_id)
+
+        start, end, seconds = query_range(start, end, increment)
+
+        if end < start:
+            return []
+
+        # Labelled as the store does, bucket by bucket from `start`.
+        results = []
+        label = start
+
+        while label + seconds <= end:
+            key = (seconds, machine_id, label + seconds)
+
+            if key not in self.entries:
+                break
+
+            self.entries.move_to_end(key)
+
+            label += seconds
+            results.append([label, self.entries[key][0]])
+
+        # The last bucket is always read, in case snapshots past `end` start a new one.
+        if len(results) > 0 and label + seconds > end:
+            results.pop()
+            label -= seconds
+
+        # Before reading, so whatever was still waiting to be written then
+        # is left out of the cache even if it is committed during the read.
+        closed = time.time() - CACHE_GRACE
+
+        oldest = self.store.oldest_pending()
+        if oldest is not None:
+            closed = min(closed, oldest)
+
+        fresh = await self.store.get_statistics(start=label, end=end, increment=increment, machine_id=machine_id)
+
+        cache_hits.inc(len(results))
+        cache_misses.inc(len(fresh))
+
+        for label, bucket in fresh:
+            if label <= end and label + seconds <= closed:
+                self.put((seconds, machine_id, label), bucket)
+
+        return results + fresh
+
+    def put(self, key, bucket):
+        if key in self.entries:
+            return
+
+        size = size_of(key) + size_of(bucket)
+
+        self.entries[key] = (bucket, size)
+        self.size += size
+
+        while self.size > self.limit:
+            key, (bucket, size) = self.entries.popitem(last=False)
+            self.size -= size
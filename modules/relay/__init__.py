@@ -1,5 +1,6 @@
 import asyncio
 
+from ivy import metrics
 from ivy.module import Module
 from ivy.net import NetConnector
 
@@ -15,5 +16,6 @@ class RelayModule(Module):
         self.ivy.register_service(self.service)
 
         asyncio.Task(http_server.start())
+        asyncio.ensure_future(metrics.monitor_loop_lag())
 
 __plugin__ = RelayModule
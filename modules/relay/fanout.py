@@ -0,0 +1,245 @@
+import time
+import asyncio
+import traceback
+from collections import deque
+
+from websockets.exceptions import ConnectionClosed
+
+from ivy import metrics
+from ivy.net import Frame, Body
+
+
+# How much is allowed to wait on a single connection before the policy for
+# the packet's event kicks in. Keeps one stalled subscriber from pinning the
+# relay's memory.
+OUTBOX_LIMITS = {
+    'messages': 1000,
+    'bytes': 16 * 1024 * 1024
+}
+
+# What to do with a packet when the outbox it's headed for is full:
+#   block        the sender waits until the subscriber catches up
+#   drop-oldest  discard the oldest queued packet to make room
+#   drop-newest  discard the new packet
+#   disconnect   close the connection, it'll have to resync anyway
+OUTBOX_POLICIES = {
+    '*': 'drop-oldest',
+
+    'machine': 'disconnect',
+    'fee': 'disconnect'
+}
+
+# In-process connections never encode frames. Each counts as the bytes it
+# arrived as, or this many if it didn't come from the wire.
+LOOPBACK_FRAME_BYTES = 1024
+
+# (event, policy): [messages, bytes], across all connections
+DROPPED = {}
+
+# (event, method): packets merged into one still queued, across all connections
+CONFLATED = {}
+
+sent_messages = metrics.counter('ivy_relay_sent_messages_total', 'Packets queued for subscribers.', ('event', 'method'))
+sent_bytes = metrics.counter('ivy_relay_sent_bytes_total', 'Encoded bytes queued for subscribers.', ('event', 'method'))
+
+fanout_latency = metrics.histogram('ivy_relay_fanout_latency_seconds', 'Time from a packet being queued to it being written to the subscriber.')
+
+metrics.counter('ivy_relay_dropped_messages_total', 'Packets dropped because a subscriber\'s outbox was full.', ('event', 'policy'),
+                    collect=lambda: {k: v[0] for k, v in DROPPED.items()})
+metrics.counter('ivy_relay_dropped_bytes_total', 'Encoded bytes dropped because a subscriber\'s outbox was full.', ('event', 'policy'),
+                    collect=lambda: {k: v[1] for k, v in DROPPED.items()})
+metrics.counter('ivy_relay_conflated_messages_total', 'Packets merged into an older one still waiting in a subscriber\'s outbox.', ('event', 'method'),
+                    collect=lambda: dict(CONFLATED))
+
+class Outbox:
+    def __init__(self, socket, logger, limits=None, policies=None, conflate=None, label=None):
+        self.socket = socket
+        self.logger = logger
+
+        # (event, method) -> metric labels, see RoutingTable.label
+        self.label = label if label else lambda event, method: (event, method)
+
+        self.limits = {**OUTBOX_LIMITS, **(limits if limits else {})}
+        self.policies = {**OUTBOX_POLICIES, **(policies if policies else {})}
+
+        # event: [method, method, method]
+        self.conflate = conflate if conflate else {}
+
+        # [frame, size, queued at], or [(event, method, sender), size, queued at] for conflated frames in `pending`
+        self.queue = deque()
+        self.bytes = 0
+
+        # (event, method, sender): [frame, merged]
+        self.pending = {}
+
+        self.ready = asyncio.Event()
+
+        # Senders blocked until there's room again
+        self.waiters = []
+
+        self.closed = False
+
+        self.dropped = 0
+        self.conflated = 0
+
+        self.task = asyncio.ensure_future(self.writer())
+
+    def conflates(self, frame):
+        if frame.rpc is not None or frame.event not in self.conflate:
+            return False
+
+        methods = self.conflate[frame.event]
+        return '*' in methods or frame.method in methods
+
+    def size(self, frame):
+        if self.socket.codec is not None:
+            return len(frame.encode(self.socket.codec, self.socket.compression))
+
+        # In-process connections (no codec) take the frame as it is.
+        return frame.body.size if frame.body.size else LOOPBACK_FRAME_BYTES
+
+    def policy(self, frame):
+        return self.policies[frame.event] if frame.event in self.policies else self.policies['*']
+
+    def full(self, size=0):
+        return len(self.queue) >= self.limits['messages'] or self.bytes + size > self.limits['bytes']
+
+    def push(self, frame):
+        # Returns None if the frame was queued (or dropped), or a future
+        # to wait on if the sender should block until there's room.
+        if self.closed:
+            return None
+
+        if self.conflates(frame):
+            key = (frame.event, frame.method, frame.sender)
+
+            # Still waiting to be sent. Fold the new values into it instead.
+            if key in self.pending:
+                self.merge(self.pending[key], frame)
+                self.conflated += 1
+
+                labels = self.label(frame.event, frame.method)
+                CONFLATED[labels] = CONFLATED.get(labels, 0) + 1
+                return None
+
+        size = self.size(frame)
+
+        waiter = None
+
+        if self.full(size):
+            policy = self.policy(frame)
+
+            if policy == 'drop-newest':
+                self.drop(frame, size, policy)
+                return None
+            elif policy == 'drop-oldest':
+                while len(self.queue) > 0 and self.full(size):
+                    item, item_size, _ = self.queue.popleft()
+                    self.bytes -= item_size
+
+                    if isinstance(item, tuple):
+                        item = self.pending.pop(item)[0]
+
+                    self.drop(item, item_size, policy)
+            elif policy == 'disconnect':
+                self.drop(frame, size, policy)
+                self.logger.warning('Outbox for %r is full. Disconnecting.' % self.socket.id)
+                self.disconnect()
+                return None
+            else:
+                # Queued anyway, so the limit can overshoot by one packet per blocked sender.
+                waiter = asyncio.get_event_loop().create_future()
+                self.waiters.append(waiter)
+
+        if self.conflates(frame):
+            self.pending[key] = [frame, False]
+            self.queue.append([key, size, time.perf_counter()])
+        else:
+            self.queue.append([frame, size, time.perf_counter()])
+
+        self.bytes += size
+
+        event, method = self.label(frame.event, frame.method)
+
+        sent_messages.inc(event=event, method=method)
+        sent_bytes.inc(size, event=event, method=method)
+
+        self.ready.set()
+        return waiter
+
+    def drop(self, frame, size, policy):
+        self.dropped += 1
+
+        key = (self.label(frame.event, frame.method)[0], policy)
+        if key not in DROPPED: DROPPED[key] = [0, 0]
+        DROPPED[key][0] += 1
+        DROPPED[key][1] += size
+
+        if self.dropped % self.limits['messages'] == 1:
+            self.logger.warning('Outbox for %r is full. %d packets dropped so far.' % (self.socket.id, self.dropped))
+
+    def merge(self, entry, frame):
+        old, merged = entry
+
+        # Payloads keyed by machine (or anything else) keep the newest value per
+        # key. Anything else is simply replaced by the newer one.
+        if not isinstance(old.body.payload, dict) or not isinstance(frame.body.payload, dict):
+            entry[0] = frame
+            entry[1] = False
+            return
+
+        if not merged:
+            entry[0] = Frame(frame.event, frame.method, Body(dict(old.body.payload)), to=frame.to, sender=frame.sender)
+            entry[1] = True
+
+        entry[0].body.payload.update(frame.body.payload)
+
+    def next(self):
+        item, size, queued = self.queue.popleft()
+        self.bytes -= size
+
+        if len(self.waiters) > 0 and not self.full():
+            for waiter in self.waiters:
+                if not waiter.done(): waiter.set_result(None)
+            self.waiters.clear()
+
+        if isinstance(item, tuple):
+            return self.pending.pop(item)[0], queued
+        return item, queued
+
+    async def writer(self):
+        try:
+            while True:
+                if len(self.queue) == 0:
+                    self.ready.clear()
+                    await self.ready.wait()
+                    continue
+
+                frame, queued = self.next()
+
+                await self.socket.send_frame(frame)
+
+                fanout_latency.observe(time.perf_counter() - queued)
+        except asyncio.CancelledError:
+            pass
+        except ConnectionClosed:
+            pass
+        except Exception:
+            self.logger.exception('\n' + traceback.format_exc())
+
+    def disconnect(self):
+        self.close()
+        self.socket.close()
+
+    def close(self):
+        self.closed = True
+
+        self.queue.clear()
+        self.pending.clear()
+        self.bytes = 0
+
+        for waiter in self.waiters:
+            if not waiter.done(): waiter.set_result(None)
+        self.waiters.clear()
+
+        self.task.cancel()
@@ -3,6 +3,8 @@ import asyncio
 
 from aiohttp import web
 
+from ivy import metrics
+
 
 dist_folder = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'dist')
 
@@ -16,6 +18,7 @@ async def index(request):
 app = web.Application()
 
 app.router.add_get('/', index)
+app.router.add_get('/metrics', metrics.handle)
 app.router.add_static('/static/', path=os.path.join(dist_folder, 'static'), name='static')
 
 
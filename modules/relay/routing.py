@@ -0,0 +1,143 @@
+class RoutingTable:
+    def __init__(self):
+        # (event, method): {id: count}, as declared in Subscribe headers
+        self.subscribers = {}
+
+        # (event, method): {id: matches}, merged across the wildcard combinations.
+        # Only kept for routes that something subscribes to by name.
+        self.routes = {}
+
+        # (event, method): (id, id, id), rebuilt lazily when a route changes
+        self.cache = {}
+
+        self.by_event = {}
+        self.by_method = {}
+
+    def affected(self, sub):
+        event, method = sub
+
+        if event == '*' and method == '*':
+            return list(self.routes)
+        elif event == '*':
+            return list(self.by_method.get(method, ()))
+        elif method == '*':
+            return list(self.by_event.get(event, ()))
+
+        return [sub] if sub in self.routes else []
+
+    def subscribe(self, id, event, method):
+        sub = (event, method)
+
+        if sub not in self.subscribers: self.subscribers[sub] = {}
+
+        # The same id may be subscribed twice while a reconnecting miner's
+        # old socket hasn't closed yet. Only the first one changes routes.
+        if id in self.subscribers[sub]:
+            self.subscribers[sub][id] += 1
+            return
+
+        self.subscribers[sub][id] = 1
+
+        for route in self.affected(sub):
+            ids = self.routes[route]
+            ids[id] = ids.get(id, 0) + 1
+
+            self.cache.pop(route, None)
+
+    def unsubscribe(self, id, event, method):
+        sub = (event, method)
+
+        if sub not in self.subscribers or id not in self.subscribers[sub]: return
+
+        if self.subscribers[sub][id] > 1:
+            self.subscribers[sub][id] -= 1
+            return
+
+        del self.subscribers[sub][id]
+        if len(self.subscribers[sub]) == 0: del self.subscribers[sub]
+
+        for route in self.affected(sub):
+            ids = self.routes[route]
+
+            if ids[id] > 1:
+                ids[id] -= 1
+            else:
+                del ids[id]
+
+            self.cache.pop(route, None)
+
+            if self.normalize(*route) != route:
+                self.forget(route)
+
+    def add(self, id, subscriptions):
+        for event, methods in subscriptions.items():
+            for method in methods:
+                self.subscribe(id, event, method)
+
+    def remove(self, id, subscriptions):
+        for event, methods in subscriptions.items():
+            for method in methods:
+                self.unsubscribe(id, event, method)
+
+    def normalize(self, event, method):
+        # Names no subscription mentions can only match '*' ones. They share
+        # that route, so packets with made-up names can't grow the table.
+        if (event, method) not in self.subscribers and (event, '*') not in self.subscribers:
+            event = '*'
+
+        if (event, method) not in self.subscribers and ('*', method) not in self.subscribers:
+            method = '*'
+
+        return event, method
+
+    def label(self, event, method):
+        # For metrics, which keep a series per label forever. Names that
+        # share the '*' route are counted together as 'other'.
+        route = self.normalize(event, method)
+
+        return (event if route[0] == event else 'other', method if route[1] == method else 'other')
+
+    def forget(self, route):
+        del self.routes[route]
+        self.cache.pop(route, None)
+
+        self.by_event[route[0]].discard(route)
+        if len(self.by_event[route[0]]) == 0: del self.by_event[route[0]]
+
+        self.by_method[route[1]].discard(route)
+        if len(self.by_method[route[1]]) == 0: del self.by_method[route[1]]
+
+    def build(self, route):
+        ids = {}
+
+        for sub in dict.fromkeys([route, (route[0], '*'), ('*', route[1]), ('*', '*')]):
+            for id in self.subscribers.get(sub, ()):
+                ids[id] = ids.get(id, 0) + 1
+
+        self.routes[route] = ids
+
+        if route[0] not in self.by_event: self.by_event[route[0]] = set()
+        self.by_event[route[0]].add(route)
+
+        if route[1] not in self.by_method: self.by_method[route[1]] = set()
+        self.by_method[route[1]].add(route)
+
+        return ids
+
+    def route(self, event, method):
+        route = self.normalize(event, method)
+
+        if route in self.cache:
+            return self.cache[route]
+
+        ids = self.routes[route] if route in self.routes else self.build(route)
+
+        self.cache[route] = tuple(ids)
+        return self.cache[route]
+
+    def route_one(self, event, method, exclude=None):
+        for id in self.route(event, method):
+            if id != exclude:
+                return id
+
+        return None
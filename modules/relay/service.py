@@ -9,7 +9,12 @@ import os
 import re
 
 from epyphany import Service
-from ivy.net import NetListener
+from ivy import metrics
+from ivy.compression import STATS as COMPRESSION_STATS
+from ivy.net import NetListener, Frame
+
+from .fanout import Outbox
+from .routing import RoutingTable
 
 
 # This value defines the maximum amount of machines allowed before
@@ -17,85 +22,201 @@ from ivy.net import NetListener
 # network lag on large farms.
 IMMEDIATE_STAT_CUTOFF = 1000
 
+# Modules on the same machine connect here instead of over TCP. Can be
+# changed with 'socket' in the relay config, or turned off with null.
+RELAY_SOCKET = '/var/run/ivy-relay.sock'
+
+# State-like events where a lagging subscriber only needs the newest value
+# per machine. Queued packets for these are merged instead of piling up.
+# Can be overridden with 'conflate' in the relay config. Not 'new_stats':
+# each one carries the shares since the last, and compute stores every one.
+CONFLATED_EVENTS = {
+    'machines': ['stats']
+}
+
+# Read-mostly catalog data. The relay keeps the latest packet of each, hands
+# it to new subscribers right away and answers 'get' requests for it itself.
+# Can be overridden with 'retain' in the relay config.
+RETAINED_EVENTS = {
+    'coins': 'data',
+    'tickers': 'data',
+    'software': 'data'
+}
+
+received_messages = metrics.counter('ivy_relay_received_messages_total', 'Packets received from connections.', ('event', 'method'))
+received_bytes = metrics.counter('ivy_relay_received_bytes_total', 'Bytes received from connections.', ('event', 'method'))
+
+metrics.counter('ivy_compression_payloads_total', 'Payloads compressed before sending.', collect=lambda: {(): COMPRESSION_STATS.messages})
+metrics.counter('ivy_compression_bytes_in_total', 'Payload bytes before compression.', collect=lambda: {(): COMPRESSION_STATS.bytes_in})
+metrics.counter('ivy_compression_bytes_out_total', 'Payload bytes after compression.', collect=lambda: {(): COMPRESSION_STATS.bytes_out})
+metrics.counter('ivy_compression_seconds_total', 'CPU time spent compressing payloads.', collect=lambda: {(): COMPRESSION_STATS.seconds})
+
 class RelayService(Service):
     def __init__(self, module, port):
         super().__init__('relay', port)
 
         self.module = module
-        self.listener = NetListener(module.logger.getChild('socket'))
+        # role ('miner' or 'other'): compression policy, see ivy.compression
+        self.listener = NetListener(module.logger.getChild('socket'),
+                                    compression=module.config['compression'] if 'compression' in module.config else None,
+                                    limits=module.config['websocket'] if 'websocket' in module.config else None,
+                                    heartbeats=module.config['heartbeat'] if 'heartbeat' in module.config else None,
+                                    rpc=False)
+
+        self.socket = module.config['socket'] if 'socket' in module.config else RELAY_SOCKET
+
+        self.conflate = module.config['conflate'] if 'conflate' in module.config else CONFLATED_EVENTS
+
+        # event: method
+        self.retain = module.config['retain'] if 'retain' in module.config else RETAINED_EVENTS
+
+        # event: latest frame
+        self.retained = {}
+
+        # {limits: {messages, bytes}, policies: {event: policy}}, see fanout.py
+        self.outbox = module.config['outbox'] if 'outbox' in module.config else {}
 
         self.register_events(self.listener)
 
-        # id: {socket, subscriptions: {event: [method, method, method]}}
+        # id: {socket, role, outbox, subscriptions: {event: [method, method, method]}}
         self.connections = {}
 
-        # sub: {method: [id, id, id]}
-        self.subscriptions = {}
+        # (event, method): (id, id, id), wildcards already merged in
+        self.routes = RoutingTable()
+
+        metrics.gauge('ivy_relay_connections', 'Open connections.', ('role',), collect=self.count_connections)
+        metrics.gauge('ivy_relay_queue_depth', 'Packets waiting in a connection\'s outbox.', ('connection',),
+                        collect=lambda: {(id,): len(conn['outbox'].queue) for id, conn in self.connections.items()})
+        metrics.gauge('ivy_relay_queue_bytes', 'Encoded bytes waiting in a connection\'s outbox.', ('connection',),
+                        collect=lambda: {(id,): conn['outbox'].bytes for id, conn in self.connections.items()})
+
+    def count_connections(self):
+        counts = {('miner',): 0, ('other',): 0}
+
+        for conn in self.connections.values():
+            counts[(conn['role'],)] += 1
+
+        return counts
 
     def start_service(self):
         self.module.logger.info('Starting relay service...')
 
         self.listener.serve('', self.port)
 
+        # Not advertised when it belongs to another relay.
+        if self.socket and not self.listener.serve_unix(self.socket):
+            self.socket = None
+
     def create_payload(self):
-        return {'id': self.module.ivy.id, 'priority': self.module.config['priority'] if 'priority' in self.module.config else 0}
+        payload = {'id': self.module.ivy.id, 'priority': self.module.config['priority'] if 'priority' in self.module.config else 0}
 
-    def register_events(self, l):
-        @l.listen_event
-        async def event(packet):
-            one = False
+        # Only usable by modules that share this machine, see Module.open_relay.
+        if self.socket:
+            payload['socket'] = self.socket
+
+        return payload
+
+    def new_outbox(self, socket):
+        return Outbox(socket, self.module.logger.getChild('outbox'),
+                        limits=self.outbox['limits'] if 'limits' in self.outbox else None,
+                        policies=self.outbox['policies'] if 'policies' in self.outbox else None,
+                        conflate=self.conflate,
+                        label=self.routes.label)
 
-            if packet.to:
-                if packet.to == 'one':
-                    one = True
-                else:
-                    if packet.to in self.connections:
-                        await self.connections[packet.to]['socket'].send(packet.event, packet.method, payload=packet.payload, sender=packet.socket.id)
-                    return
+    def send_retained(self, id):
+        subscriptions = self.connections[id]['subscriptions']
 
-            # Miner events are a special case. They're sent in bulk if the number
-            # of total machines exceeds 1000.
-            #if packet.event == 'machine':
-            #    return
+        for event, frame in self.retained.items():
+            for e in [event, '*']:
+                if e in subscriptions and (frame.method in subscriptions[e] or '*' in subscriptions[e]):
+                    self.connections[id]['outbox'].push(frame)
+                    break
 
-            if packet.event in self.subscriptions:
-                if packet.method in self.subscriptions[packet.event]:
-                    for id in self.subscriptions[packet.event][packet.method]:
-                        if id == packet.socket.id: continue
+    def forward(self, id, frame, blocked):
+        waiter = self.connections[id]['outbox'].push(frame)
 
-                        await self.connections[id]['socket'].send(packet.event, packet.method, payload=packet.payload, sender=packet.socket.id)
+        if waiter is not None:
+            blocked.append(waiter)
 
-                        if one: return
-                if '*' in self.subscriptions[packet.event]:
-                    for id in self.subscriptions[packet.event]['*']:
-                        if id == packet.socket.id: continue
+    def route(self, packet, blocked):
+        one = False
 
-                        await self.connections[id]['socket'].send(packet.event, packet.method, payload=packet.payload, sender=packet.socket.id)
+        # Every recipient gets the same frame, so it's only encoded once per
+        # codec. The payload itself is passed along without being decoded.
+        frame = Frame(packet.event, packet.method, packet.body, sender=packet.socket.id, rpc=packet.rpc)
 
-                        if one: return
+        if packet.event in self.retain and packet.rpc is None and not packet.dummy:
+            if packet.method == self.retain[packet.event]:
+                self.retained[packet.event] = frame.envelope(sender=frame.sender)
+            elif packet.method == 'get' and packet.event in self.retained:
+                self.forward(packet.socket.id, self.retained[packet.event], blocked)
+                return
 
-            if '*' in self.subscriptions:
-                if packet.method in self.subscriptions['*']:
-                    for id in self.subscriptions['*'][packet.method]:
-                        if id == packet.socket.id: continue
+        if packet.to:
+            if packet.to == 'one':
+                one = True
+            else:
+                if packet.to in self.connections:
+                    self.forward(packet.to, frame, blocked)
+                return
 
-                        await self.connections[id]['socket'].send(packet.event, packet.method, payload=packet.payload, sender=packet.socket.id)
+        # Miner events are a special case. They're sent in bulk if the number
+        # of total machines exceeds 1000.
+        #if packet.event == 'machine':
+        #    return
 
-                        if one: return
-                if '*' in self.subscriptions['*']:
-                    for id in self.subscriptions['*']['*']:
-                        if id == packet.socket.id: continue
+        if one:
+            id = self.routes.route_one(packet.event, packet.method, exclude=packet.socket.id)
 
-                        await self.connections[id]['socket'].send(packet.event, packet.method, payload=packet.payload, sender=packet.socket.id)
+            if id is not None:
+                self.forward(id, frame, blocked)
+            return
 
-                        if one: return
+        for id in self.routes.route(packet.event, packet.method):
+            if id == packet.socket.id: continue
+
+            self.forward(id, frame, blocked)
+
+    def register_events(self, l):
+        @l.listen_event
+        async def event(packet):
+            if not packet.dummy:
+                event, method = self.routes.label(packet.event, packet.method)
+
+                received_messages.inc(event=event, method=method)
+                received_bytes.inc(packet.body.size if packet.body.size else 0, event=event, method=method)
+
+            # Subscribers already saw the newer connection open.
+            if hasattr(packet, 'replaced') and packet.replaced:
+                return
+
+            blocked = []
+
+            self.route(packet, blocked)
+
+            # Subscribers with a 'block' policy hold up the sender, but only
+            # after everyone else already has the packet.
+            if len(blocked) > 0:
+                await asyncio.wait(blocked)
 
         @l.listen_event('connection', 'open')
         async def event(packet):
+            role = 'other'
+
             if 'Miner-ID' in packet.payload['headers']:
                 packet.socket.id = packet.payload['headers']['Miner-ID']
+                role = 'miner'
+
+            # A rig that reconnected before its old socket was noticed gone.
+            if packet.socket.id in self.connections:
+                old = self.connections.pop(packet.socket.id)
+
+                self.routes.remove(packet.socket.id, old['subscriptions'])
 
-            self.connections[packet.socket.id] = {'socket': packet.socket, 'subscriptions': {}}
+                old['outbox'].close()
+                old['socket'].close(1001)
+
+            self.connections[packet.socket.id] = {'socket': packet.socket, 'role': role, 'outbox': self.new_outbox(packet.socket), 'subscriptions': {}}
 
             subscribe = None
 
@@ -114,15 +235,19 @@ class RelayService(Service):
                 except:
                     self.module.logger.warning('Failed to load Subscribe: %s' % subscribe)
 
-            for event, methods in self.connections[packet.socket.id]['subscriptions'].items():
-                if event not in self.subscriptions: self.subscriptions[event] = {}
-                for method in methods:
-                    if method not in self.subscriptions[event]: self.subscriptions[event][method] = []
-                    self.subscriptions[event][method].append(packet.socket.id)
+            self.routes.add(packet.socket.id, self.connections[packet.socket.id]['subscriptions'])
+
+            self.send_retained(packet.socket.id)
 
         @l.listen_event('connection', 'closed')
         async def event(packet):
-            for event, methods in self.connections[packet.socket.id]['subscriptions'].items():
-                for method in methods:
-                    self.subscriptions[event][method].remove(packet.socket.id)
+            # Already replaced by a newer connection with the same id. Runs
+            # before the catch-all listener, which then doesn't route it.
+            if packet.socket.id not in self.connections or self.connections[packet.socket.id]['socket'] is not packet.socket:
+                packet.replaced = True
+                return
+
+            self.routes.remove(packet.socket.id, self.connections[packet.socket.id]['subscriptions'])
+
+            self.connections[packet.socket.id]['outbox'].close()
             del self.connections[packet.socket.id]